@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the text preprocessing and the lemma cleanup against their earlier multi-pass versions.
+
+Usage:
+    python benchmarks/bench_preprocessing.py --texts 100000
+"""
+
+import argparse, os, random, re, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fingerGeoparser.toponym_tagger import LEMMA_TABLE, toponym_tagger  # noqa: E402
+from synthetic import LEMMAS, generate_texts  # noqa: E402
+
+
+NOISE = ['@ystävä', '#helsinki', 'https://t.co/xYz123', '&amp;', '<3', '😀', '👍🏽', '🇫🇮', '☀️']
+
+
+def legacy_preprocess_sent(sent):
+    """preprocess_sent before the noise was removed in one pass (without emoji removal)."""
+    sent = re.sub(r'@\S+ *', '', sent)
+    sent = sent.replace('#', '')
+    sent = sent.replace('<3', '')
+    sent = re.sub(r'&amp|&', '', sent)
+    sent = re.sub(r'http[s]?://\S+', "", sent)
+    return sent
+
+
+def legacy_clean_lemma(lemma):
+    lemma = lemma.replace("#", "")
+    return re.sub(r'[.?!;:\'"“”‘’]', '', lemma)
+
+
+def noisy_texts(n, seed=0):
+    """Synthetic texts with social media noise (mentions, hashtags, URLs and emojis) sprinkled in."""
+    rng = random.Random(seed)
+    texts = []
+    for text in generate_texts(n, seed=seed):
+        words = text.split()
+        for _ in range(rng.randint(0, 4)):
+            words.insert(rng.randint(0, len(words)), rng.choice(NOISE))
+        texts.append(' '.join(words))
+    return texts
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--texts', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    texts = noisy_texts(args.texts)
+    # lemmas with some of the characters the cleanup removes
+    rng = random.Random(0)
+    lemmas = [rng.choice(list(LEMMAS.values())) + rng.choice(['', '', '.', '"', '#', '!']) for _ in range(args.texts)]
+    tagger = toponym_tagger(use_gpu=False)
+
+    rows = [('preprocess (per text)', best_of(lambda: [legacy_preprocess_sent(t) for t in texts], args.repeat),
+             best_of(lambda: [tagger.preprocess_sent(t, remove_emojis=False) for t in texts], args.repeat)),
+            ('preprocess (batch)', best_of(lambda: [legacy_preprocess_sent(t) for t in texts], args.repeat),
+             best_of(lambda: tagger.preprocess_texts(texts, remove_emojis=False), args.repeat)),
+            ('preprocess + emojis (batch)', None, best_of(lambda: tagger.preprocess_texts(texts), args.repeat)),
+            ('lemma cleanup', best_of(lambda: [legacy_clean_lemma(lemma) for lemma in lemmas], args.repeat),
+             best_of(lambda: [lemma.translate(LEMMA_TABLE) for lemma in lemmas], args.repeat))]
+
+    print(f"{args.texts} texts / lemmas, best of {args.repeat} runs")
+    print(f"{'':<30}{'legacy (s)':>12}{'new (s)':>12}{'speedup':>10}")
+    for name, legacy, new in rows:
+        if legacy is None:
+            print(f"{name:<30}{'':>12}{new:>12.4f}")
+        else:
+            print(f"{name:<30}{legacy:>12.4f}{new:>12.4f}{legacy / new:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the geoparsing pipeline. Synthetic texts are tagged with a stand-in Spacy pipeline
+(or a real one given with --pipeline) and geocoded against a local mock Pelias server.
+
+Usage:
+    python benchmarks/run_benchmarks.py --texts 20000 --output results.json
+    python benchmarks/run_benchmarks.py --compare results.json
+
+The results (texts/s, toponyms/s, p50/p99 latency of each stage per chunk and peak memory) are printed and
+written as JSON, together with the commit they were measured on, so that runs can be compared across commits.
+"""
+
+import argparse, json, os, platform, resource, statistics, subprocess, sys, tempfile, time, tracemalloc, zlib
+
+# progress bars would only distort the timings
+os.environ.setdefault('TQDM_DISABLE', '1')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# the stand-ins for the Spacy pipeline and Pelias are shared with the tests
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from fingerGeoparser import geoparser  # noqa: E402
+from fingerGeoparser.metrics import geoparse_stats  # noqa: E402
+from stubs import build_stub_pipeline, feature, pelias_stub  # noqa: E402
+from synthetic import LEMMAS, TOPONYMS, generate_texts  # noqa: E402
+
+
+def percentile(values, q):
+    """The q:th percentile (0-100) of the values, interpolated between the closest ranks."""
+    values = sorted(values)
+    if len(values) == 1:
+        return values[0]
+    pos = (len(values) - 1) * q / 100
+    low = int(pos)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (pos - low)
+
+
+def peak_rss_mb():
+    """Peak resident set size of the process in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def synthetic_features(text, size):
+    """The mock geocoder's answer: 'size' candidates with stable made-up coordinates for each synthetic toponym."""
+    features = []
+    if text in TOPONYMS:
+        for i in range(size):
+            h = zlib.crc32(f'{text}{i}'.encode())
+            lon, lat = 20 + h % 1000 / 100, 60 + h % 500 / 100
+            features.append(feature(lon, lat, f'whosonfirst:locality:{h}', 'locality', f'{text}, Finland',
+                                    bbox=[lon - 0.1, lat - 0.1, lon + 0.1, lat + 0.1]))
+    return features
+
+
+def merge_stats(total, stats):
+    """Adds the timers, counters and histograms of a call's stats to the total."""
+    for name, seconds in stats.timers.items():
+        total.add_time(name, seconds)
+    for name, n in stats.counters.items():
+        total.count(name, n)
+    for name, values in stats.histograms.items():
+        total.histograms.setdefault(name, []).extend(values)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(args):
+    texts = generate_texts(args.texts, words_per_text=args.words, toponym_density=args.density,
+                           duplicate_share=args.duplicates, seed=args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pipeline_path = args.pipeline
+        if pipeline_path is None:
+            pipeline_path = os.path.join(tmp, 'pipeline')
+            build_stub_pipeline({form: 'GPE' for form in LEMMAS}, LEMMAS).to_disk(pipeline_path)
+        server = pelias_stub(synthetic_features, latency=args.latency).start()
+        try:
+            gp = geoparser.geoparser(pipeline_path=pipeline_path, use_gpu=False, verbose=False,
+                                     geocoder_url=server.url, health_check=False, lemma_memo=args.lemma_memo,
+                                     lemmatize_on_miss=args.lemma_memo, deduplicate_texts=args.deduplicate,
+                                     token_budget=args.token_budget)
+            # load the pipeline outside the measurements
+            gp.geoparse(texts[:10])
+            server.requests.clear()
+
+            if args.trace_memory:
+                tracemalloc.start()
+
+            # the stages of each chunk as geoparse recorded them in last_stats, and the whole call
+            stages = {}
+            # the stats of all the chunks summed up, e.g. the request latencies
+            stats = geoparse_stats()
+            n_toponyms = 0
+            start = time.perf_counter()
+            for i in range(0, len(texts), args.chunk_size):
+                t = time.perf_counter()
+                res = gp.geoparse(texts[i:i + args.chunk_size], pipelined=args.pipelined, batch_size=args.batch_size)
+                stages.setdefault('chunk_total', []).append(time.perf_counter() - t)
+
+                for name, seconds in gp.last_stats.timers.items():
+                    stages.setdefault(name, []).append(seconds)
+                merge_stats(stats, gp.last_stats)
+                n_toponyms += int(res['toponyms_found'].sum())
+            elapsed = time.perf_counter() - start
+
+            traced_peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if args.trace_memory else None
+            if args.trace_memory:
+                tracemalloc.stop()
+            requests = len(server.requests)
+        finally:
+            server.stop()
+
+    return {'texts': len(texts),
+            'toponyms': n_toponyms,
+            'geocoder_requests': requests,
+            'elapsed_s': elapsed,
+            'texts_per_s': len(texts) / elapsed,
+            'toponyms_per_s': n_toponyms / elapsed,
+            'stages': {name: {'p50_s': percentile(times, 50), 'p99_s': percentile(times, 99),
+                              'mean_s': statistics.mean(times), 'total_s': sum(times)}
+                       for name, times in stages.items()},
+            'pipeline_stats': stats.as_dict(),
+            'peak_rss_mb': peak_rss_mb(),
+            'traced_peak_mb': traced_peak}
+
+
+def compare(old, new):
+    """Prints the change of the headline metrics between two result files."""
+    rows = [('texts/s', old['results']['texts_per_s'], new['results']['texts_per_s']),
+            ('toponyms/s', old['results']['toponyms_per_s'], new['results']['toponyms_per_s']),
+            ('peak RSS (MB)', old['results']['peak_rss_mb'], new['results']['peak_rss_mb'])]
+    for stage in new['results']['stages']:
+        if stage in old['results']['stages']:
+            rows.append((f'{stage} p50 (s)', old['results']['stages'][stage]['p50_s'], new['results']['stages'][stage]['p50_s']))
+            rows.append((f'{stage} p99 (s)', old['results']['stages'][stage]['p99_s'], new['results']['stages'][stage]['p99_s']))
+
+    print(f"{'':<28}{old.get('commit') or 'old':>12}{new.get('commit') or 'new':>12}{'change':>10}")
+    for name, a, b in rows:
+        change = f'{(b - a) / a * 100:+.1f}%' if a else ''
+        print(f'{name:<28}{a:>12.4g}{b:>12.4g}{change:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--texts', type=int, default=5000, help='number of synthetic texts')
+    parser.add_argument('--words', type=int, default=15, help='average number of words per text')
+    parser.add_argument('--density', type=float, default=0.1, help='probability of a word being a toponym')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='share of exact duplicate texts')
+    parser.add_argument('--chunk-size', type=int, default=500, help='texts per geoparsed chunk')
+    parser.add_argument('--batch-size', type=int, default=None, help='texts per Spacy pipeline batch')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='geocode each tagged batch while the next ones are still being tagged')
+    parser.add_argument('--lemma-memo', action='store_true',
+                        help='memoize the lemmas of toponyms and only lemmatize texts with unseen forms')
+    parser.add_argument('--deduplicate', action='store_true', help='tag each distinct text only once')
+    parser.add_argument('--token-budget', type=int, default=None,
+                        help='sort the texts by length and batch them by this many tokens')
+    parser.add_argument('--latency', type=float, default=0.005, help='artificial latency of the mock geocoder in seconds')
+    parser.add_argument('--pipeline', default=None, help='a real Spacy pipeline to use instead of the stand-in')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='also measure the peak of Python allocations with tracemalloc (slows the run down)')
+    parser.add_argument('--output', default=None, help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None, help='compare the results to an earlier JSON file')
+    args = parser.parse_args()
+
+    results = run(args)
+    report = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'platform': platform.platform(),
+              'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+              'results': results}
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Finnish-like texts for benchmarking the geoparser.
+"""
+
+import random
+
+
+# toponyms in a few inflected forms and their lemmas, as a lemmatizer would return them
+TOPONYMS = {'Helsinki': ['Helsinki', 'Helsingissä', 'Helsingistä', 'Helsinkiin'],
+            'Tampere': ['Tampere', 'Tampereella', 'Tampereelta', 'Tampereelle'],
+            'Turku': ['Turku', 'Turussa', 'Turusta', 'Turkuun'],
+            'Oulu': ['Oulu', 'Oulussa', 'Oulusta', 'Ouluun'],
+            'Kamppi': ['Kamppi', 'Kampissa', 'Kampista', 'Kamppiin'],
+            'Lahti': ['Lahti', 'Lahdessa', 'Lahdesta', 'Lahteen'],
+            'Rovaniemi': ['Rovaniemi', 'Rovaniemellä', 'Rovaniemeltä', 'Rovaniemelle'],
+            'Suomi': ['Suomi', 'Suomessa', 'Suomesta', 'Suomeen']}
+
+LEMMAS = {form: lemma for lemma, forms in TOPONYMS.items() for form in forms}
+
+WORDS = ['tänään', 'olin', 'menen', 'huomenna', 'kaunis', 'ilma', 'kahvi', 'juna', 'myöhässä', 'taas', 'ja', 'mutta',
+         'kun', 'sitten', 'hyvä', 'päivä', 'ihana', 'sää', 'kesä', 'talvi', 'lumi', 'sade', 'ystävä', 'kanssa', 'on',
+         'oli', 'ei', 'kyllä', 'vielä', 'aina', 'koti', 'työ', 'kauppa', 'ruoka', 'kirja', 'elokuva', 'konsertti']
+
+
+def generate_texts(n, words_per_text=15, toponym_density=0.1, duplicate_share=0.0, seed=0):
+    """Generates n texts of about 'words_per_text' words, where each word is a toponym with the probability
+    'toponym_density'. 'duplicate_share' of the texts are exact copies of earlier ones, like retweets."""
+    rng = random.Random(seed)
+    forms = list(LEMMAS)
+    texts = []
+    for i in range(n):
+        if texts and rng.random() < duplicate_share:
+            texts.append(rng.choice(texts))
+            continue
+        length = max(1, int(rng.gauss(words_per_text, words_per_text / 3)))
+        words = [rng.choice(forms) if rng.random() < toponym_density else rng.choice(WORDS) for _ in range(length)]
+        words[0] = words[0].capitalize()
+        texts.append(' '.join(words) + rng.choice(['.', '!', '?', '']))
+    return texts
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Geoparses large files in chunks. Each chunk is written to its own output file as soon as it's ready, and a
+manifest of the finished chunks lets an interrupted job continue from where it stopped.
+
+Usage:
+    finger-batch posts.csv results/ --text-column text --id-column id --chunk-size 10000
+    python -m fingerGeoparser.batch_job posts.parquet results/ --output-format jsonl
+"""
+
+import argparse, json, os, time
+
+import pandas as pd
+
+
+INPUT_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.jsonl': 'jsonl', '.json': 'jsonl', '.ndjson': 'jsonl'}
+OUTPUT_FORMATS = ('parquet', 'jsonl')
+
+
+def output_types(explode_df=True):
+    """The Arrow types of the known output columns of geoparse. The toponym columns hold a value per toponym with
+    explode_df=True and a list of them per text otherwise."""
+    import pyarrow as pa
+
+    toponym_type = (lambda arrow_type: arrow_type) if explode_df else pa.list_
+    point = pa.list_(pa.float64())
+    return {'input_text': pa.string(), 'toponyms_found': pa.bool_(), 'input_order': pa.int64(),
+            'toponyms': toponym_type(pa.string()), 'topo_lemmas': toponym_type(pa.string()),
+            'topo_labels': toponym_type(pa.string()), 'topo_spans': toponym_type(pa.list_(pa.int64())),
+            'coordinates': toponym_type(point), 'gid': toponym_type(pa.string()), 'layer': toponym_type(pa.string()),
+            'label': toponym_type(pa.string()), 'bbox': toponym_type(point)}
+
+
+class batch_job:
+    """
+    A resumable geoparsing job over a CSV, Parquet or JSONL (JSON lines) file.
+
+    The input is read chunk_size rows at a time, so the memory use stays bounded regardless of the size of the file.
+    The results of each chunk are written to output_dir as part-00000.parquet, part-00001.parquet etc. (or .jsonl).
+    The Parquet parts share one schema, so the directory can be read as a single dataset, e.g. with
+    pd.read_parquet(output_dir). The finished chunks are listed in output_dir/_manifest.json, which Parquet readers
+    skip like other files starting with an underscore. When a job is run again, the chunks already in the manifest
+    are skipped. The files are written under temporary names and renamed when complete, so an interruption never
+    leaves half-written results.
+
+    Parameters:
+        gp | geoparser: the geoparser used for the chunks.
+
+        input_path | String: path to a .csv, .parquet or .jsonl file.
+
+        output_dir | String: directory for the output files and the manifest. Created if needed.
+
+        text_column | String: the column containing the texts. Default 'text'.
+
+        id_column | String: a column with an identifier of each text, returned in the 'id' column. Default None.
+
+        chunk_size | Int: how many rows are geoparsed at once. Default 10000.
+
+        input_format | String: 'csv', 'parquet' or 'jsonl'. Default None (deduced from the file extension).
+
+        output_format | String: 'parquet' (requires pyarrow) or 'jsonl'. Default 'parquet'.
+
+        verbose | Boolean: Prints the progress of the job. Default True.
+
+        Other keyword arguments are passed to geoparser.geoparse, e.g. geocoder_params or pipelined=True.
+        The input_order column of the output runs over the whole input file.
+    """
+
+    def __init__(self, gp, input_path, output_dir, text_column='text', id_column=None, chunk_size=10000,
+                 input_format=None, output_format='parquet', verbose=True, **geoparse_kwargs):
+        if input_format is None:
+            input_format = INPUT_FORMATS.get(os.path.splitext(input_path)[1].lower())
+            if input_format is None:
+                raise ValueError("Couldn't tell the input format from the file extension. Provide input_format.")
+        if input_format not in INPUT_FORMATS.values():
+            raise ValueError("input_format must be 'csv', 'parquet' or 'jsonl'.")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("output_format must be 'parquet' or 'jsonl'.")
+        if geoparse_kwargs.get('output', 'all') != 'all':
+            raise ValueError("Batch jobs write DataFrames, so output must be 'all'.")
+
+        self.gp = gp
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.text_column = text_column
+        self.id_column = id_column
+        self.chunk_size = chunk_size
+        self.input_format = input_format
+        self.output_format = output_format
+        self.verbose = verbose
+        self.geoparse_kwargs = geoparse_kwargs
+
+        self.manifest_path = os.path.join(output_dir, '_manifest.json')
+        # the Arrow schema of the Parquet parts, see output_schema
+        self.schema = None
+
+    def run(self):
+        """Geoparses the chunks that aren't finished yet. Output: the manifest as a dictionary."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        manifest = self.load_manifest()
+
+        t = time.time()
+        for index, chunk in enumerate(self.read_chunks()):
+            if str(index) in manifest['chunks']:
+                continue
+
+            chunk_start = time.time()
+            texts = chunk[self.text_column].fillna('').astype(str).tolist()
+            ids = chunk[self.id_column].tolist() if self.id_column else None
+
+            results = self.gp.geoparse(texts, ids=ids, **self.geoparse_kwargs)
+            results['input_order'] += index * self.chunk_size
+
+            file_name = f"part-{index:05d}.{self.output_format}"
+            self.write_chunk(results, os.path.join(self.output_dir, file_name), manifest)
+
+            manifest['chunks'][str(index)] = {'file': file_name, 'rows_in': len(chunk), 'rows_out': len(results),
+                                              'seconds': round(time.time() - chunk_start, 3)}
+            self.save_manifest(manifest)
+
+            if self.verbose:
+                print(f"Chunk {index} done: {len(chunk)} texts in {round(time.time() - chunk_start, 2)} s.")
+
+        manifest['finished'] = True
+        self.save_manifest(manifest)
+
+        if self.verbose:
+            print(f"Job finished after {round(time.time() - t, 2)} s. The results are in {self.output_dir}.")
+        return manifest
+
+    def read_chunks(self):
+        """Yields the input file as DataFrames of chunk_size rows."""
+        columns = [self.text_column] + ([self.id_column] if self.id_column else [])
+
+        if self.input_format == 'csv':
+            yield from pd.read_csv(self.input_path, usecols=columns, chunksize=self.chunk_size)
+        elif self.input_format == 'jsonl':
+            for chunk in pd.read_json(self.input_path, lines=True, chunksize=self.chunk_size):
+                yield chunk[columns]
+        else:
+            try:
+                import pyarrow.parquet as pq
+            except ImportError:
+                raise ImportError("Reading Parquet files requires pyarrow. Install it with 'pip install pyarrow'.")
+
+            for batch in pq.ParquetFile(self.input_path).iter_batches(batch_size=self.chunk_size, columns=columns):
+                yield batch.to_pandas()
+
+    def write_chunk(self, df, path, manifest):
+        """Writes the results of a chunk under a temporary name and renames the file when it's complete."""
+        tmp_path = path + '.tmp'
+        if self.output_format == 'parquet':
+            import pyarrow as pa, pyarrow.parquet as pq
+
+            if self.schema is None:
+                self.schema = self.output_schema(df, manifest)
+            pq.write_table(pa.Table.from_pandas(df, schema=self.schema, preserve_index=False), tmp_path)
+        else:
+            df.to_json(tmp_path, orient='records', lines=True, force_ascii=False)
+        os.replace(tmp_path, path)
+
+    def output_schema(self, df, manifest):
+        """The Arrow schema of the Parquet parts. A resumed job takes it from the parts already written. Otherwise
+        the known columns get their types from output_types, so that a chunk without toponyms, whose toponym columns
+        are all empty, has the same schema as the rest. Other columns, such as the ids, get the types of the first
+        chunk."""
+        import pyarrow as pa, pyarrow.parquet as pq
+
+        if manifest['chunks']:
+            first = next(iter(manifest['chunks'].values()))
+            return pq.read_schema(os.path.join(self.output_dir, first['file'])).remove_metadata()
+
+        types = output_types(self.geoparse_kwargs.get('explode_df', True))
+        return pa.schema([pa.field(field.name, types.get(field.name, field.type))
+                          for field in pa.Schema.from_pandas(df, preserve_index=False)])
+
+    def load_manifest(self):
+        """Reads the manifest of an earlier run of the job, or starts a new one."""
+        settings = {'input': os.path.abspath(self.input_path), 'chunk_size': self.chunk_size,
+                    'output_format': self.output_format}
+
+        if not os.path.exists(self.manifest_path):
+            return {**settings, 'chunks': {}, 'finished': False}
+
+        with open(self.manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+
+        # the chunks only line up if they were cut the same way
+        for key, value in settings.items():
+            if manifest.get(key) != value:
+                raise ValueError(f"The output directory has a job with a different {key} ({manifest.get(key)}). "
+                                 "Use another directory or remove the old manifest.")
+        return manifest
+
+    def save_manifest(self, manifest):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='a .csv, .parquet or .jsonl file')
+    parser.add_argument('output_dir', help='directory for the results and the manifest')
+    parser.add_argument('--text-column', default='text')
+    parser.add_argument('--id-column', default=None)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--input-format', choices=sorted(set(INPUT_FORMATS.values())), default=None)
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='parquet')
+    parser.add_argument('--pipeline', default='fi_geoparser', help='name or path of the Spacy pipeline')
+    parser.add_argument('--gpu', action='store_true', help='run the pipeline on the GPU')
+    parser.add_argument('--n-process', type=int, default=1)
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--geocoder-url', default=None, help='URL of a Pelias geocoder')
+    parser.add_argument('--geocoder-cache', default=None, help='SQLite file for caching the geocoding results')
+    parser.add_argument('--gazetteer', default=None, help='geocode offline from a GeoNames dump or index instead')
+    parser.add_argument('--country', default=None, help="limit the geocoding to countries, e.g. 'FIN'")
+    parser.add_argument('--preprocess', action='store_true', help='remove mentions, URLs etc. before tagging')
+    parser.add_argument('--nested', action='store_true', help='one row per text instead of one per toponym')
+    parser.add_argument('--drop-non-locations', action='store_true')
+    parser.add_argument('--pipelined', action='store_true', help='overlap the tagging and geocoding of each chunk')
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    from fingerGeoparser.geoparser import geoparser
+
+    gp_kwargs = {'pipeline_path': args.pipeline, 'use_gpu': args.gpu, 'n_process': args.n_process,
+                 'batch_size': args.batch_size, 'geocoder_cache': args.geocoder_cache, 'verbose': False}
+    if args.gazetteer:
+        from fingerGeoparser.gazetteer_coder import gazetteer_coder
+        gp_kwargs['geocoder'] = gazetteer_coder(args.gazetteer)
+    elif args.geocoder_url:
+        gp_kwargs['geocoder_url'] = args.geocoder_url
+
+    job = batch_job(geoparser(**gp_kwargs), args.input, args.output_dir,
+                    text_column=args.text_column, id_column=args.id_column, chunk_size=args.chunk_size,
+                    input_format=args.input_format, output_format=args.output_format, verbose=not args.quiet,
+                    explode_df=not args.nested, preprocess_texts=args.preprocess,
+                    drop_non_locations=args.drop_non_locations, pipelined=args.pipelined,
+                    geocoder_params={'boundary.country': args.country} if args.country else None)
+    job.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+A persistent SQLite store for keeping results between runs, and a memo of toponym lemmas.
+"""
+
+import json, os, sqlite3, threading, time
+
+from collections import OrderedDict
+
+
+class persistent_cache:
+    """
+    A small key-value store on top of SQLite, used to keep results across runs.
+    Values are stored as JSON. Entries older than 'ttl' seconds are treated as
+    misses, and once the store grows past 'max_entries', the least recently used
+    entries are evicted.
+
+    Parameters:
+        path | String: path to the SQLite file. ":memory:" keeps the cache in memory only.
+
+        ttl | Float: Time-to-live of an entry in seconds. None (default) means that entries never expire.
+
+        max_entries | Int: Maximum number of entries kept in the store. None (default) means no limit.
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # the connection may be used from worker threads, the lock serializes the access
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                key TEXT PRIMARY KEY,
+                                value TEXT,
+                                created REAL,
+                                accessed REAL)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        """Forms a stable string key from JSON serializable parts. Dictionaries are sorted by their keys."""
+        return json.dumps(parts, ensure_ascii=False, sort_keys=True)
+
+    def get_many(self, keys):
+        """Input: a list of keys.
+        Output: a dictionary of the keys found in the cache and their values. Missing and expired keys are left out."""
+        found = {}
+        now = time.time()
+        expired = []
+
+        with self._lock:
+            # SQLite limits the number of variables in a single query, so query in slices
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                rows = self._conn.execute("SELECT key, value, created FROM cache WHERE key IN ({})".format(",".join("?"*len(chunk))),
+                                          chunk).fetchall()
+                for key, value, created in rows:
+                    if self.ttl is not None and now - created > self.ttl:
+                        expired.append((key,))
+                    else:
+                        found[key] = json.loads(value)
+
+            if expired:
+                self._conn.executemany("DELETE FROM cache WHERE key = ?", expired)
+            if found:
+                self._conn.executemany("UPDATE cache SET accessed = ? WHERE key = ?", [(now, key) for key in found])
+            self._conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    def set_many(self, items):
+        """Input: a dictionary of keys and JSON serializable values to store."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                                   [(key, json.dumps(value, ensure_ascii=False), now, now) for key, value in items.items()])
+            self._evict()
+            self._conn.commit()
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def _evict(self):
+        """Removes the least recently used entries if the store has grown past max_entries."""
+        if self.max_entries is None:
+            return
+
+        count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)", (excess,))
+            self.evictions += excess
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self):
+        """Returns the hit and miss counters of the cache as a dictionary."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class lemma_memo:
+    """
+    A bounded in-memory memo of toponym lemmas, keyed on the surface form of the toponym, its label and
+    whether the toponyms were filtered. Social media texts repeat the same forms ("Helsingissä", "Tampereella")
+    over and over, and the memo lets the tagger skip their lemmatization and cleanup. Once it's full, the least
+    recently used forms are evicted. A lemma is assumed to depend only on the form, not on the context.
+
+    Parameters:
+        max_entries | Int: Maximum number of memoized forms. Default 100000.
+
+        path | String: A JSON file the memo is loaded from, if it exists, and written to with save(). Default None.
+    """
+
+    def __init__(self, max_entries=100000, path=None):
+        self.max_entries = max_entries
+        self.path = path
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lemmas = OrderedDict()
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def get(self, key):
+        """Returns the lemma memoized for the key, or None."""
+        lemma = self._lemmas.get(key)
+        if lemma is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._lemmas.move_to_end(key)
+        return lemma
+
+    def __contains__(self, key):
+        return key in self._lemmas
+
+    def set(self, key, lemma):
+        self._lemmas[key] = lemma
+        self._lemmas.move_to_end(key)
+        if len(self._lemmas) > self.max_entries:
+            self._lemmas.popitem(last=False)
+            self.evictions += 1
+
+    def save(self, path=None):
+        """Writes the memo to a JSON file, by default to the path given at init."""
+        path = path or self.path
+        assert path, "Provide a path to save the memo to."
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump([[*key, lemma] for key, lemma in self._lemmas.items()], f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """Adds the forms saved with save() to the memo."""
+        with open(path, encoding='utf-8') as f:
+            for text, label, filtered, lemma in json.load(f):
+                self.set((text, label, filtered), lemma)
+
+    def __len__(self):
+        return len(self._lemmas)
+
+    def stats(self):
+        """Returns the hit and miss counters of the memo as a dictionary."""
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self._lemmas),
+                'hit_rate': self.hits / lookups if lookups else 0.0}
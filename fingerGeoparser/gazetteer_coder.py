@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+An offline geocoder that resolves toponyms from a GeoNames dump instead of a Pelias service.
+"""
+
+import csv, os
+
+import numpy as np, pandas as pd
+
+from fingerGeoparser.country_codes import ALPHA3_TO_ALPHA2
+
+
+# the columns of GeoNames dumps (e.g. allCountries.txt or FI.txt), see https://download.geonames.org/export/dump/
+GEONAMES_COLUMNS = ['geonameid', 'name', 'asciiname', 'alternatenames', 'latitude', 'longitude', 'feature_class',
+                    'feature_code', 'country_code', 'cc2', 'admin1_code', 'admin2_code', 'admin3_code', 'admin4_code',
+                    'population', 'elevation', 'dem', 'timezone', 'modification_date']
+
+# when populations are equal, administrative areas and populated places come first
+FEATURE_CLASS_RANK = {'A': 0, 'P': 1, 'L': 2, 'T': 3, 'H': 4, 'V': 5, 'S': 6, 'R': 7, 'U': 8}
+
+# arrays saved by save() and memory-mapped by load()
+INDEX_ARRAYS = ('geonameids', 'lons', 'lats', 'populations', 'feature_classes', 'feature_codes', 'country_codes',
+                'label_bytes', 'label_offsets', 'name_offsets', 'name_rows')
+
+
+class gazetteer_coder:
+    """
+    An offline geocoder, which resolves toponyms from a local GeoNames dump (or another TSV file with the same
+    columns) instead of a Pelias service. It has the same interface as toponym_coder, so it can be passed to the
+    geoparser with geoparser(geocoder=gazetteer_coder(...)).
+
+    The places are indexed by all of their names (name, ASCII name and alternate names), normalized to lowercase.
+    When a name refers to several places, the one with the largest population is returned, with administrative
+    areas and populated places preferred over other features.
+
+    Parameters:
+        gazetteer_path | String: path to a GeoNames dump, such as FI.txt or allCountries.txt, or to an index
+                                 directory written with save().
+
+        country_info_path | String: path to GeoNames' countryInfo.txt. If given, the labels include the country
+                                    names (e.g. "Helsinki, Finland"). Default None.
+
+        mmap | Boolean: Whether the arrays of a saved index are memory-mapped instead of read into memory. Default True.
+
+    Like in Pelias, 'boundary.country' takes ISO alpha-3 codes (e.g. 'FIN'). Alpha-2 codes work too.
+    """
+
+    def __init__(self, gazetteer_path, country_info_path=None, mmap=True):
+        self.cache = None
+        self.country_names, alpha3 = read_country_info(country_info_path) if country_info_path else ({}, {})
+        self.alpha3 = {**ALPHA3_TO_ALPHA2, **alpha3}
+
+        if os.path.isdir(gazetteer_path):
+            self.load(gazetteer_path, mmap=mmap)
+        else:
+            self.build(gazetteer_path)
+
+    def build(self, path):
+        """Reads a GeoNames dump and builds the name index."""
+        df = pd.read_csv(path, sep='\t', header=None, names=GEONAMES_COLUMNS, quoting=csv.QUOTE_NONE,
+                         usecols=['geonameid', 'name', 'asciiname', 'alternatenames', 'latitude', 'longitude',
+                                  'feature_class', 'feature_code', 'country_code', 'population'],
+                         dtype={'name': str, 'asciiname': str, 'alternatenames': str, 'feature_class': str,
+                                'feature_code': str, 'country_code': str},
+                         keep_default_na=False, na_values={'population': ['']}, encoding='utf-8')
+
+        self.geonameids = df['geonameid'].to_numpy(dtype=np.int64)
+        self.lons = df['longitude'].to_numpy(dtype=np.float64)
+        self.lats = df['latitude'].to_numpy(dtype=np.float64)
+        self.populations = df['population'].fillna(0).to_numpy(dtype=np.int64)
+        # the codes are short ASCII strings, so fixed width bytes keep them compact
+        self.feature_classes = df['feature_class'].str.encode('ascii', 'replace').to_numpy(dtype='S1')
+        self.feature_codes = df['feature_code'].str.encode('ascii', 'replace').to_numpy(dtype='S10')
+        self.country_codes = df['country_code'].str.encode('ascii', 'replace').to_numpy(dtype='S2')
+        # names vary in length, so they are stored as one UTF-8 buffer and the offsets of each name in it
+        encoded = df['name'].str.encode('utf-8')
+        self.label_offsets = np.zeros(len(df) + 1, dtype=np.int64)
+        np.cumsum(encoded.str.len().to_numpy(), out=self.label_offsets[1:])
+        self.label_bytes = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+        # rank the places: the most populous first, ties broken by the feature class
+        class_rank = df['feature_class'].map(FEATURE_CLASS_RANK).fillna(len(FEATURE_CLASS_RANK)).to_numpy()
+        rank = np.empty(len(df), dtype=np.int64)
+        rank[np.lexsort((class_rank, -self.populations))] = np.arange(len(df))
+
+        # every (normalized name, place) pair, sorted by name and then by rank
+        alternates = df['alternatenames'].str.split(',').explode()
+        names = pd.concat([df['name'], df['asciiname'], alternates])
+        names = normalize_names(names[names.str.len() > 0])
+        pairs = pd.DataFrame({'name': names.to_numpy(), 'row': names.index.to_numpy()}).drop_duplicates()
+        pairs['rank'] = rank[pairs['row'].to_numpy()]
+        pairs = pairs.sort_values(['name', 'rank'], kind='mergesort')
+
+        codes, self.names = pd.factorize(pairs['name'])
+        self.name_rows = pairs['row'].to_numpy(dtype=np.int64)
+        # the places of name i are name_rows[name_offsets[i]:name_offsets[i+1]]
+        self.name_offsets = np.searchsorted(codes, np.arange(len(self.names) + 1)).astype(np.int64)
+        self.name_index = {name: i for i, name in enumerate(self.names)}
+
+    def save(self, directory):
+        """Writes the index to a directory as NumPy arrays, which can be memory-mapped when loaded."""
+        os.makedirs(directory, exist_ok=True)
+        for name in INDEX_ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), getattr(self, name))
+        with open(os.path.join(directory, 'names.txt'), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(self.names))
+
+    def load(self, directory, mmap=True):
+        """Loads an index written with save()."""
+        for name in INDEX_ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None))
+        with open(os.path.join(directory, 'names.txt'), encoding='utf-8') as f:
+            self.names = f.read().split('\n')
+        self.name_index = {name: i for i, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.geonameids)
+
+    async def geocode_toponyms(self, toponyms, columns=['coordinates', 'gid', 'layer', 'label', 'bbox'], params=None, stats=None):
+        """Input: a list of toponyms, usually lemmatized.
+        Output: a dictionary of lists with the same columns as toponym_coder returns, with Nones for toponyms not found.
+        If a geoparse_stats object is given as stats, the number of unique toponyms is recorded in it."""
+        lists = {key: list() for key in columns}
+
+        # like Pelias, up to 10 candidates by default
+        size = int(params.get('size', 10)) if params else 10
+        others = [key for key in columns if key != 'candidates']
+
+        resolved = {}
+        for toponym in toponyms:
+            if toponym not in resolved:
+                rows = self.lookup_all(toponym, params, size) if isinstance(toponym, str) else []
+                values = self.row_values(rows[0], columns) if rows else None
+                if values and 'candidates' in columns:
+                    values[columns.index('candidates')] = [self.row_values(row, others) for row in rows]
+                resolved[toponym] = values
+
+            values = resolved[toponym]
+            for i, this_list in enumerate(lists.values()):
+                this_list.append(values[i] if values else None)
+
+        if stats is not None:
+            stats.count('unique_lemmas', sum(1 for toponym in resolved if toponym))
+        return lists
+
+    def lookup(self, toponym, params=None):
+        """Returns the index of the best ranked place with the name, or None. Supports the Pelias parameters
+        'boundary.country', 'layers' and 'boundary.rect.*'."""
+        rows = self.lookup_all(toponym, params, size=1)
+        return rows[0] if rows else None
+
+    def lookup_all(self, toponym, params=None, size=None):
+        """Returns the indices of the (at most size) best ranked places with the name that pass the parameters."""
+        i = self.name_index.get(toponym.strip().casefold())
+        if i is None:
+            return []
+
+        rows = self.name_rows[self.name_offsets[i]:self.name_offsets[i+1]]
+        if not params:
+            return [int(row) for row in rows[:size]]
+
+        found = []
+        for row in rows:
+            if self.matches(int(row), params):
+                found.append(int(row))
+                if size is not None and len(found) == size:
+                    break
+        return found
+
+    def matches(self, row, params):
+        """Whether the place on the row passes the filtering parameters."""
+        country = params.get('boundary.country')
+        if country:
+            if self.country_code(row) not in self.boundary_codes(country):
+                return False
+
+        layers = params.get('layers')
+        if layers and self.layer(row) not in layers.split(','):
+            return False
+
+        lon, lat = self.lons[row], self.lats[row]
+        if not (float(params.get('boundary.rect.min_lon', -180)) <= lon <= float(params.get('boundary.rect.max_lon', 180)) and
+                float(params.get('boundary.rect.min_lat', -90)) <= lat <= float(params.get('boundary.rect.max_lat', 90))):
+            return False
+
+        return True
+
+    def boundary_codes(self, country):
+        """Converts a comma-separated 'boundary.country' value to a set of the alpha-2 codes of GeoNames."""
+        codes = set()
+        for code in country.split(','):
+            code = code.strip().upper()
+            if len(code) == 3:
+                if code not in self.alpha3:
+                    raise ValueError(f"Unknown country code '{code}' in boundary.country.")
+                code = self.alpha3[code]
+            codes.add(code)
+        return codes
+
+    def name(self, row):
+        return bytes(self.label_bytes[self.label_offsets[row]:self.label_offsets[row+1]]).decode('utf-8')
+
+    def country_code(self, row):
+        return self.country_codes[row].decode()
+
+    def layer(self, row):
+        """Maps the GeoNames feature code of a place to the closest Pelias layer."""
+        code = self.feature_codes[row].decode()
+        if code.startswith('PCL'):
+            return 'country'
+        if code == 'ADM1':
+            return 'region'
+        if code == 'ADM2':
+            return 'county'
+        if code.startswith('ADM'):
+            return 'localadmin'
+        if code == 'PPLX':
+            return 'neighbourhood'
+        if self.feature_classes[row] == b'P':
+            return 'locality'
+        return 'venue'
+
+    def row_values(self, row, columns):
+        """The values of the requested columns for the place on the row, in the same format as Pelias returns them."""
+        layer = self.layer(row)
+        name = self.name(row)
+        country_code = self.country_code(row)
+        country = self.country_names.get(country_code, country_code)
+
+        values = []
+        for key in columns:
+            if key == 'coordinates':
+                values.append([float(self.lons[row]), float(self.lats[row])])
+            elif key == 'gid':
+                values.append(f"geonames:{layer}:{self.geonameids[row]}")
+            elif key == 'layer':
+                values.append(layer)
+            elif key == 'label':
+                values.append(f"{name}, {country}" if country else name)
+            elif key == 'name':
+                values.append(name)
+            elif key == 'country_code':
+                values.append(country_code)
+            elif key == 'population':
+                values.append(int(self.populations[row]))
+            elif key == 'source':
+                values.append('geonames')
+            elif key == 'type':
+                values.append('Point')
+            else:
+                # e.g. bbox, which GeoNames doesn't have
+                values.append(None)
+        return values
+
+
+def normalize_names(names):
+    """Lowercases and strips the names in a Pandas Series."""
+    return names.str.strip().str.casefold()
+
+
+def read_country_info(path):
+    """Reads GeoNames' countryInfo.txt. Returns the country names and an ISO alpha-3 to alpha-2 mapping."""
+    names, alpha3 = {}, {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            names[fields[0]] = fields[4]
+            alpha3[fields[1]] = fields[0]
+    return names, alpha3
@@ -9,10 +9,15 @@ Created on Wed Mar 24 18:55:46 2021
 
 from fingerGeoparser.toponym_tagger import toponym_tagger
 from fingerGeoparser.toponym_coder import toponym_coder
-from fingerGeoparser.output_formatter import create_eupeg_json
+from fingerGeoparser.output_formatter import create_eupeg_json, write_results
+from fingerGeoparser.metrics import geoparse_stats, profiled_thread, profiling, timed
 
 
-import time, asyncio, pandas as pd
+import time, asyncio, threading
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 
 class geoparser:
     """
@@ -39,7 +44,24 @@ class geoparser:
              use_gpu=False,
              output_df=True,
              verbose=True,
-             geocoder_url="http://vm5121.kaj.pouta.csc.fi:4000/v1/"):
+             geocoder_url="http://vm5121.kaj.pouta.csc.fi:4000/v1/",
+             geocoder_cache=None,
+             n_process=1,
+             batch_size=None,
+             pipeline_mode='full',
+             dtype_backend=None,
+             geocoder=None,
+             warm_up=False,
+             health_check='background',
+             progress=None,
+             hooks=None,
+             lemma_memo=None,
+             lemmatize_on_miss=False,
+             deduplicate_texts=False,
+             text_cache=None,
+             token_budget=None,
+             max_text_tokens=512,
+             candidates=1):
         """
         Parameters:
         pipeline_path | String: name of the Spacy pipeline, which is called with spacy.load().
@@ -57,13 +79,112 @@ class geoparser:
         geocoder_url : str, optional
             URL for the Pelias geocoder instance. Default instance is maintained by the author for now and is located at "http://vm5121.kaj.pouta.csc.fi:4000/v1/".
 
+        geocoder_cache : str, optional
+            Path to a SQLite file where the geocoding results are kept between runs. Each unique toponym is geocoded
+            only once per batch regardless. Default is None (no persistent cache).
+
+        n_process : int, optional
+            Number of CPU processes used for toponym recognition. The pipeline is loaded once per process and
+            the results keep the input order. -1 uses all cores. Default is 1.
+
+        batch_size : int, optional
+            Number of texts the Spacy pipeline processes at once. Default is None (the pipeline's default).
+
+        pipeline_mode : str, optional
+            'full' runs the whole Spacy pipeline. 'lean' disables the components not needed for recognizing and
+            lemmatizing toponyms (e.g. the dependency parser), which speeds up tagging. See
+            tagger.component_timings() for a per-component breakdown. Default is 'full'.
+
+        dtype_backend : str, optional
+            'pyarrow' returns the text columns of the output as Arrow-backed dtypes, if pyarrow is installed.
+            Default is None (NumPy-backed object columns).
+
+        geocoder : object, optional
+            A geocoder to use instead of the Pelias service at geocoder_url, e.g. a gazetteer_coder, which resolves
+            toponyms offline from a local GeoNames dump. It must implement geocode_toponyms like toponym_coder does.
+            Default is None (Pelias at geocoder_url).
+
+        warm_up : bool, optional
+            The Spacy pipeline is loaded when it's first needed. If True, loading starts right away in a background
+            thread. Default is False.
+
+        health_check : str or bool, optional
+            How the geocoder is checked: 'background' (default) checks it without blocking and warns if it's down,
+            'sync' raises an error right away if it's down, and False skips the check.
+
+        progress : bool, optional
+            Whether progress bars are shown while tagging and geocoding. Default is None (shown if verbose).
+
+        hooks : list of callables, optional
+            Called as hook(event, name, value) whenever a stage finishes ('stage', stage name, seconds), a counter
+            is incremented ('count', counter name, increment) or a geocoder latency is recorded ('observe',
+            'geocoder_latency', seconds), e.g. for forwarding the metrics to a monitoring system. The same
+            metrics of the latest call are kept in geoparser.last_stats. Default is None.
+
+        lemma_memo : bool or lemma_memo, optional
+            Memoizes the lemmas of toponyms by their surface forms across calls, so that repeated forms are not
+            lemmatized again. True creates a memo in memory, and a fingerGeoparser.cache.lemma_memo(path=...) can be
+            saved and reused between runs. Its hit rate is in geoparser.tagger.lemma_memo.stats(). Default is None.
+
+        lemmatize_on_miss : bool, optional
+            With a lemma_memo, leaves the lemmatizer out of the pipeline and runs it only on the texts with toponyms
+            that aren't memoized. Pays off with a lemmatizer that is slow compared to the rest of the pipeline.
+            Default is False.
+
+        deduplicate_texts : bool, optional
+            Tags each distinct text only once and copies the toponyms to its duplicates, e.g. retweets. The output
+            still has a row (or rows) for every input text. Default is False.
+
+        text_cache : str, optional
+            Path to a SQLite file where the toponyms of each tagged text are kept between runs, keyed by a hash of
+            the text and the pipeline. Texts tagged in earlier runs are not tagged again. Implies deduplicate_texts.
+            Default is None (no text cache).
+
+        token_budget : int, optional
+            Sorts the texts by length and batches them by the number of (estimated) tokens, padding included, instead
+            of a fixed number of texts. Keeps short texts from being padded to long ones, and the memory use of a
+            batch predictable. The output keeps the input order. Default is None (texts batched in arrival order).
+
+        max_text_tokens : int, optional
+            With a token_budget, texts longer than this many words are tagged in windows of whole sentences and the
+            spans are mapped back to the full text. Default is 512.
+
+        candidates : int, optional
+            How many candidate locations the geocoder returns for each toponym. With more than one, the candidate
+            closest to the other toponyms of the same text is chosen, unless the geocoder's ranking clearly
+            favours another one (see fingerGeoparser.spatial.disambiguate). Requires the 'coordinates' column.
+            Default is 1 (the geocoder's first choice).
+
         """
 
-        self.tagger = toponym_tagger(pipeline_path, use_gpu=use_gpu)
+        progress = verbose if progress is None else progress
+
+        self.tagger = toponym_tagger(pipeline_path, use_gpu=use_gpu, n_process=n_process, batch_size=batch_size,
+                                     pipeline_mode=pipeline_mode, dtype_backend=dtype_backend, progress=progress,
+                                     lemma_memo=lemma_memo, lemmatize_on_miss=lemmatize_on_miss,
+                                     deduplicate=deduplicate_texts, text_cache=text_cache,
+                                     token_budget=token_budget, max_text_tokens=max_text_tokens)
+
+        if warm_up:
+            self.tagger.warm_up()
         
-        self.coder = toponym_coder(geocoder_url)
+        if geocoder is not None:
+            self.coder = geocoder
+        else:
+            self.coder = toponym_coder(geocoder_url, cache_path=geocoder_cache, health_check=health_check,
+                                       progress=progress)
         
         self.verbose=verbose
+
+        self.candidates = candidates
+
+        self.hooks = list(hooks or [])
+
+        # the geoparse_stats of the latest geoparse or geoparse_stream call
+        self.last_stats = None
+
+        # ageoparse runs the tagging in this thread, one batch at a time, so that the event loop isn't blocked
+        self._tag_executor = None
         
         
     def geoparse(self, 
@@ -77,7 +198,11 @@ class geoparser:
              filter_toponyms=True, 
              entity_tags=['LOC', 'FAC', 'GPE'],
              geocoder_columns =['coordinates', 'gid', 'layer', 'label', 'bbox'],
-             geocoder_params = None):
+             geocoder_params = None,
+             n_process=None,
+             batch_size=None,
+             profile=None,
+             pipelined=False):
         """
         The whole geoparsing pipeline.
 
@@ -110,6 +235,21 @@ class geoparser:
                                                      ['coordinates', 'gid', 'layer', 'label', 'bbox'].
             geocoder_params | Dict[str], optional: Parameters to limit the search to, for example, a certain country. Provide as {'parameter':'value'} dictionaries. For example: {'boundary.country':'FIN'} See https://github.com/pelias/documentation/blob/master/search.md for a full list of search parameters.
 
+            n_process | int, optional: Number of processes for toponym recognition. Default is None (the value given at init).
+
+            batch_size | int, optional: Number of texts per pipeline batch. Default is None (the value given at init).
+
+            profile | str, optional: Runs the call under a profiler: 'cprofile' (the standard library's deterministic
+                                     profiler) or 'sampling' (pyinstrument, with less overhead). The result is kept in
+                                     geoparser.last_stats.profile, e.g. last_stats.profile.print_stats(20) for cProfile.
+                                     With pipelined=True, only cProfile covers the tagging, which runs in another
+                                     thread. Default is None (not profiled).
+
+            pipelined | bool, optional: Whether geocoding starts while the texts are still being tagged. The lemmas of
+                                        each tagged batch (see batch_size) are queued for the geocoder right away, so
+                                        the CPU-bound tagging and the network-bound geocoding overlap. Worth it for
+                                        large inputs with a remote geocoder. Default is False.
+
         Output:
             Pandas DataFrame containing columns:
                 - input_text: the input sentence
@@ -127,62 +267,394 @@ class geoparser:
         Returns:
             Pandas DataFrame or dict: Depending on the 'output' parameter, either a Pandas DataFrame is returned 
                                        containing the geoparsing results, or a dictionary in EUPEG style JSON format.
+                                       The timings and counters of the call are in geoparser.last_stats.
         """
 
-        # Validate inputs
-        if not texts:
-            raise ValueError("Input texts are missing. Expecting a string or a list of strings.")
+        texts, ids = self.check_inputs(texts, ids)
+        geocoder_columns, geocoder_params = self._geocoder_request(geocoder_columns, geocoder_params)
 
-        # fix if someone passes just a string
-        if isinstance(texts, str):
-            texts = [texts]
-            
         if output.lower() == 'eupeg':
             explode_df = True
-        
-        # check that ids are in proper formats and lengths
-        if ids:
-            if isinstance(ids, (str, int, float)):
-                ids = [ids]
-            if len(ids) != len(texts):
-                raise ValueError("If ids are provided, the number of ids must be equal to the number of texts.")
             
-        
-        if self.verbose:
-            print("Starting geotagging...")
+        stats = self.last_stats = geoparse_stats(self.hooks)
+        with profiling(profile, stats):
+            return self._geoparse(texts, ids, explode_df, preprocess_texts, drop_non_locations, output,
+                                  filter_toponyms, entity_tags, geocoder_columns, geocoder_params, n_process,
+                                  batch_size, stats, pipelined)
+
+    def _geoparse(self, texts, ids, explode_df, preprocess_texts, drop_non_locations, output, filter_toponyms,
+                  entity_tags, geocoder_columns, geocoder_params, n_process, batch_size, stats, pipelined):
+        """The steps of geoparse() after the inputs have been validated."""
         t = time.time()
-        
-        # TOPONYM RECOGNITION
-        tag_results = self.tagger.tag_sentences(texts, ids, explode_df=explode_df,
-                                                drop_non_locs=drop_non_locations,
-                                                filter_toponyms=filter_toponyms,
-                                                entity_tags=entity_tags,
-                                               preprocess=preprocess_texts)
+        tag_kwargs = {'filter_toponyms': filter_toponyms, 'entity_tags': entity_tags, 'preprocess': preprocess_texts,
+                      'n_process': n_process, 'batch_size': batch_size, 'stats': stats}
 
-        if self.verbose:
-            successfuls = tag_results['toponyms_found'].tolist()
-            print("Finished geotagging after", round(time.time()-t, 2),"s.", successfuls.count(True), "location hits found.")
-            print("Starting geocoding...")
-        
-        # TOPONYM RESOLVING
-        # TODO: Reimplement shp_points
-        geocode_results = asyncio.run(self.coder.geocode_toponyms(tag_results['topo_lemmas'].tolist(),
-                                                   columns=geocoder_columns))
+        if pipelined:
+            if self.verbose:
+                print("Starting geotagging and geocoding...")
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                tag_results, geocode_results = run_sync(self._tag_and_geocode(texts, tag_kwargs, geocoder_columns,
+                                                                              geocoder_params, stats, executor,
+                                                                              close_session=True))
+            if self.verbose:
+                print("Finished geotagging and geocoding after", round(time.time()-t, 2), "s.",
+                      len(tag_results.toponyms), "location hits found.")
+        else:
+            if self.verbose:
+                print("Starting geotagging...")
 
-        
-        geocoded =  pd.DataFrame(geocode_results)
-        
-        tag_results = tag_results.reset_index(drop=True)
-        
-        # concatenate (add the columns) from the geocoder results to the tagging results to produce the final result
-        results = pd.concat([tag_results, geocoded], axis=1)
+            # TOPONYM RECOGNITION
+            # the results are kept as flat columns of toponyms until the output DataFrame is built
+            tag_results = self.tagger.tag_texts(texts, **tag_kwargs)
+
+            if self.verbose:
+                print("Finished geotagging after", round(time.time()-t, 2),"s.", len(tag_results.toponyms), "location hits found.")
+                print("Starting geocoding...")
+            
+            # TOPONYM RESOLVING
+            # TODO: Reimplement shp_points
+            with stats.stage('geocoding'):
+                geocode_results = run_sync(self._geocode(tag_results.topo_lemmas, geocoder_columns, geocoder_params,
+                                                         stats, close_session=True))
+
+        self._disambiguate(tag_results, geocode_results, stats)
+
+        # lay out the tagging and geocoding results (which are in the same order) as the output DataFrame
+        results = self.tagger.to_dataframe(tag_results, ids, explode_df=explode_df,
+                                           drop_non_locs=drop_non_locations,
+                                           extra_columns=geocode_results,
+                                           stats=stats)
         
         if self.verbose:
             print("Finished geocoding, returning output.")
             print("Total elapsed time:", round(time.time()-t, 2),"s")
             
         if output.lower() == 'eupeg':
-            return create_eupeg_json(results)
+            with stats.stage('output_formatting'):
+                return create_eupeg_json(results)
         else:
             return results
 
+    async def ageoparse(self,
+             texts,
+             ids=None,
+             explode_df=True,
+             preprocess_texts=False,
+             drop_non_locations=False,
+             output='all',
+             filter_toponyms=True,
+             entity_tags=['LOC', 'FAC', 'GPE'],
+             geocoder_columns=['coordinates', 'gid', 'layer', 'label', 'bbox'],
+             geocoder_params=None,
+             n_process=None,
+             batch_size=None,
+             pipelined=False):
+        """
+        The same as geoparse(), but a coroutine for running inside an event loop, e.g. in an aiohttp or FastAPI
+        service or in Jupyter: results = await gp.ageoparse(texts).
+
+        The toponym recognition runs in a background thread, so the event loop is free to serve other requests in
+        the meanwhile, and the geocoding is awaited on the caller's loop. Concurrent calls share the geocoder's
+        connections and concurrency limit, and their tagging runs one batch at a time. The connections are kept
+        open between calls until aclose() is awaited (or the geoparser is used with 'async with').
+
+        The parameters and the output are the same as in geoparse(), except that there is no return_shapely_points
+        (which geoparse() doesn't implement yet either) and no profile: the profilers follow a single thread, while
+        the coroutine is interleaved with the other tasks of the loop. Profile geoparse() instead.
+        """
+        texts, ids = self.check_inputs(texts, ids)
+        geocoder_columns, geocoder_params = self._geocoder_request(geocoder_columns, geocoder_params)
+
+        if output.lower() == 'eupeg':
+            explode_df = True
+
+        stats = self.last_stats = geoparse_stats(self.hooks)
+        loop = asyncio.get_running_loop()
+        if self._tag_executor is None:
+            self._tag_executor = ThreadPoolExecutor(max_workers=1)
+
+        tag_kwargs = {'filter_toponyms': filter_toponyms, 'entity_tags': entity_tags, 'preprocess': preprocess_texts,
+                      'n_process': n_process, 'batch_size': batch_size, 'stats': stats}
+
+        if pipelined:
+            tag_results, geocode_results = await self._tag_and_geocode(texts, tag_kwargs, geocoder_columns,
+                                                                       geocoder_params, stats, self._tag_executor)
+        else:
+            tag_results = await loop.run_in_executor(self._tag_executor, partial(self.tagger.tag_texts, texts,
+                                                                                 **tag_kwargs))
+
+            with stats.stage('geocoding'):
+                geocode_results = await self._geocode(tag_results.topo_lemmas, geocoder_columns, geocoder_params, stats)
+
+        self._disambiguate(tag_results, geocode_results, stats)
+        results = await loop.run_in_executor(None, partial(self.tagger.to_dataframe, tag_results, ids,
+                                                           explode_df=explode_df,
+                                                           drop_non_locs=drop_non_locations,
+                                                           extra_columns=geocode_results,
+                                                           stats=stats))
+
+        if output.lower() == 'eupeg':
+            with stats.stage('output_formatting'):
+                return create_eupeg_json(results)
+        return results
+
+    async def aclose(self):
+        """Closes the geocoder's connections of the running event loop and stops the tagging thread of ageoparse()."""
+        if hasattr(self.coder, 'aclose'):
+            await self.coder.aclose()
+        if self._tag_executor is not None:
+            self._tag_executor.shutdown(wait=False)
+            self._tag_executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def _geocoder_request(self, columns, params):
+        """The columns and parameters asked from the geocoder. With candidates, the top candidates of each toponym
+        are requested too."""
+        if self.candidates <= 1:
+            return columns, params
+        if 'coordinates' not in columns:
+            raise ValueError("Choosing between candidates requires the 'coordinates' column.")
+        return [*columns, 'candidates'], {'size': self.candidates, **(params or {})}
+
+    def _disambiguate(self, tag_results, geocode_results, stats):
+        """Chooses the locations of the toponyms from their candidates, if they were requested."""
+        if 'candidates' not in geocode_results:
+            return
+        from fingerGeoparser.spatial import disambiguate
+
+        with timed(stats, 'disambiguation'):
+            changed = disambiguate(tag_results.counts, tag_results.topo_lemmas, geocode_results)
+        if stats is not None:
+            stats.count('disambiguated', changed)
+
+    async def _geocode(self, toponyms, columns, params, stats, close_session=False):
+        """Geocodes the toponyms on the running event loop. A loop that is closed afterwards (like the ones of
+        asyncio.run) closes its connections with close_session."""
+        try:
+            return await self.coder.geocode_toponyms(toponyms, columns=columns, params=params, stats=stats)
+        finally:
+            if close_session and hasattr(self.coder, 'aclose'):
+                await self.coder.aclose()
+
+    async def _tag_and_geocode(self, texts, tag_kwargs, columns, params, stats, executor, close_session=False,
+                               workers=2, queue_size=4):
+        """Tags the texts in the executor's thread and geocodes the lemmas of each tagged batch at the same time
+        on the running event loop. The tagging waits when queue_size batches are already waiting for the geocoder.
+        Each unique lemma is geocoded only once, even if it occurs in several batches.
+
+        Output: the tag_buffer of the texts and the geocoding results of its toponyms, like geocode_toponyms returns."""
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=queue_size)
+        requested = set()
+        resolved = {}
+        # set if geocoding fails, so that the tagging stops instead of waiting for the queue forever
+        stop = threading.Event()
+
+        def on_batch(lemmas):
+            # called in the tagging thread
+            if stop.is_set():
+                raise RuntimeError("Geocoding failed, tagging was stopped.")
+            asyncio.run_coroutine_threadsafe(queue.put(lemmas), loop).result()
+
+        async def consume():
+            while True:
+                lemmas = await queue.get()
+                if lemmas is None:
+                    return
+                new = [topo for topo in dict.fromkeys(lemmas) if topo and topo not in requested]
+                if not new:
+                    continue
+                requested.update(new)
+                with stats.stage('geocoding'):
+                    lists = await self.coder.geocode_toponyms(new, columns=columns, params=params, stats=stats)
+                for i, topo in enumerate(new):
+                    resolved[topo] = [lists[key][i] for key in columns]
+
+        async def drain():
+            while True:
+                await queue.get()
+
+        consumers = [asyncio.ensure_future(consume()) for _ in range(workers)]
+        tagging = loop.run_in_executor(executor, partial(profiled_thread(stats, self.tagger.tag_texts), texts,
+                                                         on_batch=on_batch, **tag_kwargs))
+        try:
+            # consumers only finish before the tagging if they fail
+            await asyncio.wait([tagging, *consumers], return_when=asyncio.FIRST_COMPLETED)
+            if any(task.done() and task.exception() for task in consumers):
+                # unblock the tagging thread and let it finish before raising the error
+                stop.set()
+                draining = asyncio.ensure_future(drain())
+                await asyncio.wait([tagging])
+                draining.cancel()
+                # the tagging was stopped on purpose, so its error is retrieved but not the one raised
+                tagging.exception()
+                errors = [task.exception() for task in consumers if task.done()]
+                raise next(error for error in errors if error)
+
+            tag_results = await tagging
+            for _ in consumers:
+                await queue.put(None)
+            await asyncio.gather(*consumers)
+        finally:
+            for task in consumers:
+                task.cancel()
+            if close_session and hasattr(self.coder, 'aclose'):
+                await self.coder.aclose()
+
+        geocode_results = {key: [] for key in columns}
+        for topo in tag_results.topo_lemmas:
+            values = resolved.get(topo) if topo else None
+            for i, key in enumerate(columns):
+                geocode_results[key].append(values[i] if values else None)
+
+        return tag_results, geocode_results
+
+    def check_inputs(self, texts, ids):
+        """Validates the input texts and ids, and wraps single values into lists."""
+        if not texts:
+            raise ValueError("Input texts are missing. Expecting a string or a list of strings.")
+
+        # fix if someone passes just a string
+        if isinstance(texts, str):
+            texts = [texts]
+        
+        # check that ids are in proper formats and lengths
+        if ids is not None:
+            if isinstance(ids, (str, int, float)):
+                ids = [ids]
+            if len(ids) != len(texts):
+                raise ValueError("If ids are provided, the number of ids must be equal to the number of texts.")
+
+        return texts, ids
+
+    def geoparse_stream(self,
+             texts,
+             ids=None,
+             chunk_size=1000,
+             explode_df=True,
+             preprocess_texts=False,
+             drop_non_locations=False,
+             output='all',
+             filter_toponyms=True,
+             entity_tags=['LOC', 'FAC', 'GPE'],
+             geocoder_columns=['coordinates', 'gid', 'layer', 'label', 'bbox'],
+             geocoder_params=None,
+             n_process=None,
+             batch_size=None):
+        """
+        Geoparses an iterable of texts of any length in chunks and yields the results chunk by chunk.
+
+        The texts (and ids) are read lazily, so only a couple of chunks are held in memory at a time. While one chunk
+        is geocoded in a background thread, the next one is already being tagged. The input_order column runs over
+        the whole stream, not per chunk.
+
+        Input:
+            texts | Iterable[str]: The input texts, e.g. a generator reading lines from a file.
+
+            ids | Iterable[str/int/float], optional: Identifying element of each input. Must be as long as texts.
+
+            chunk_size | int, optional: How many texts are geoparsed at once. Default is 1000.
+
+            The rest of the parameters are the same as in geoparse().
+
+        Yields:
+            Pandas DataFrame or str: The results of each chunk, as described in geoparse(). The timings and counters
+                                     are summed over the chunks in geoparser.last_stats.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        texts = iter(texts)
+        ids = iter(ids) if ids is not None else None
+        geocoder_columns, geocoder_params = self._geocoder_request(geocoder_columns, geocoder_params)
+
+        if output.lower() == 'eupeg':
+            explode_df = True
+
+        stats = self.last_stats = geoparse_stats(self.hooks)
+
+        def geocode(tag_results, chunk_ids, offset):
+            with stats.stage('geocoding'):
+                geocode_results = run_sync(self._geocode(tag_results.topo_lemmas, geocoder_columns, geocoder_params,
+                                                         stats, close_session=True))
+            self._disambiguate(tag_results, geocode_results, stats)
+            return self.tagger.to_dataframe(tag_results, chunk_ids, explode_df=explode_df,
+                                            drop_non_locs=drop_non_locations,
+                                            extra_columns=geocode_results, order_offset=offset, stats=stats)
+
+        offset = 0
+        pending = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                chunk = list(islice(texts, chunk_size))
+                if chunk:
+                    chunk_ids = None
+                    if ids is not None:
+                        chunk_ids = list(islice(ids, len(chunk)))
+                        if len(chunk_ids) != len(chunk):
+                            raise ValueError("If ids are provided, the number of ids must be equal to the number of texts.")
+
+                    # tag this chunk while the previous one is still being geocoded
+                    tag_results = self.tagger.tag_texts(chunk,
+                                                        filter_toponyms=filter_toponyms,
+                                                        entity_tags=entity_tags,
+                                                        preprocess=preprocess_texts,
+                                                        n_process=n_process,
+                                                        batch_size=batch_size,
+                                                        stats=stats)
+                    chunk_offset = offset
+                    offset += len(chunk)
+                elif ids is not None and list(islice(ids, 1)):
+                    # the texts ran out before the ids
+                    raise ValueError("If ids are provided, the number of ids must be equal to the number of texts.")
+
+                if pending is not None:
+                    results = pending.result()
+                    if self.verbose:
+                        print("Geoparsed", offset - (len(chunk) if chunk else 0), "texts so far.")
+                    if output.lower() == 'eupeg':
+                        with timed(stats, 'output_formatting'):
+                            results = create_eupeg_json(results)
+                    yield results
+
+                if not chunk:
+                    break
+
+                pending = executor.submit(geocode, tag_results, chunk_ids, chunk_offset)
+
+    def geoparse_to_file(self, texts, path, output_format='geojson', ids=None, chunk_size=1000, **kwargs):
+        """
+        Geoparses the texts in chunks like geoparse_stream and writes each chunk to a file as soon as it's ready,
+        so neither the results nor their serialized form are ever held in memory in full.
+
+        Input:
+            texts | Iterable[str]: The input texts.
+
+            path | str or file: The output path or an open text file handle.
+
+            output_format | str, optional: 'geojson' (a FeatureCollection of the geocoded toponyms), 'jsonl' (a line
+                                           of JSON per row) or 'eupeg'. Default is 'geojson'.
+
+            ids | Iterable[str/int/float], optional: Identifying element of each input.
+
+            chunk_size | int, optional: How many texts are geoparsed at once. Default is 1000.
+
+            Other keyword arguments are passed to geoparse_stream. For 'geojson' and 'eupeg', explode_df must be True.
+        """
+        write_results(self.geoparse_stream(texts, ids=ids, chunk_size=chunk_size, **kwargs), path, output_format)
+
+
+def run_sync(coro):
+    """Runs a coroutine to completion from synchronous code. If an event loop is already running in this thread
+    (e.g. in Jupyter), the coroutine is run on a new loop in another thread, as asyncio.run can't be nested."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Timings, counters and histograms of geoparsing runs, the hooks they are passed on to, and profiling.
+"""
+
+import threading, time
+
+from contextlib import contextmanager, nullcontext
+
+
+class geoparse_stats:
+    """
+    Collects the timings, counters and histograms of a geoparsing run. The geoparser creates one for each
+    call and keeps the latest one in geoparser.last_stats.
+
+    Stages (seconds spent): preprocess, spacy_pipe, feature_extraction, dataframe, geocoding, concat, output_formatting
+    Counters: texts, entities, unique_lemmas, cache_hits, cache_misses, http_requests, http_retries, http_errors, http_failures
+    Histograms: geocoder_latency (seconds per request)
+
+    Parameters:
+        hooks | List of callables: called as hook(event, name, value) whenever something is recorded. The event is
+                                   'stage' (value is the seconds spent), 'count' (value is the increment) or
+                                   'observe' (value is the observation, e.g. the latency of a request).
+    """
+
+    def __init__(self, hooks=None):
+        self.timers = {}
+        self.counters = {}
+        self.histograms = {}
+        self.hooks = list(hooks or [])
+        # a pstats.Stats or a pyinstrument session, if the run was profiled
+        self.profile = None
+        # the cProfile profilers of the other threads of the run, while it is profiled with cProfile
+        self._thread_profilers = None
+        # the geocoding runs in another thread in some modes
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block as a stage. Times of the same stage are summed."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+        self._emit('stage', name, seconds)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        self._emit('count', name, n)
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms.setdefault(name, []).append(value)
+        self._emit('observe', name, value)
+
+    def _emit(self, event, name, value):
+        for hook in self.hooks:
+            hook(event, name, value)
+
+    def summary(self, name):
+        """Count, mean, p50, p90, p99 and max of a histogram."""
+        values = sorted(self.histograms.get(name, []))
+        if not values:
+            return {'count': 0}
+
+        def pct(q):
+            return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+        return {'count': len(values), 'mean': sum(values) / len(values), 'p50': pct(50), 'p90': pct(90),
+                'p99': pct(99), 'max': values[-1]}
+
+    def as_dict(self):
+        return {'timers': dict(self.timers), 'counters': dict(self.counters),
+                'histograms': {name: self.summary(name) for name in self.histograms}}
+
+    def __repr__(self):
+        timers = ', '.join(f"{name}={seconds:.3f}s" for name, seconds in self.timers.items())
+        return f"geoparse_stats({timers}; {self.counters})"
+
+
+def timed(stats, name):
+    """stats.stage(name), or a context manager doing nothing if stats is None."""
+    return stats.stage(name) if stats is not None else nullcontext()
+
+
+@contextmanager
+def profiling(kind, stats):
+    """Runs the block under a profiler and stores the result in stats.profile.
+
+    kind | String: None (no profiling), 'cprofile' (deterministic, from the standard library) or 'sampling'
+                   (a sampling profiler with less overhead, requires pyinstrument). Both follow the calling thread;
+                   cProfile also covers the functions wrapped with profiled_thread(), pyinstrument doesn't."""
+    if not kind:
+        yield
+        return
+
+    if kind == 'cprofile':
+        import cProfile, pstats
+
+        profiler = cProfile.Profile()
+        stats._thread_profilers = []
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            stats.profile = pstats.Stats(profiler, *stats._thread_profilers).sort_stats('cumulative')
+            stats._thread_profilers = None
+    elif kind == 'sampling':
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise ImportError("Sampling profiling requires pyinstrument. Install it with 'pip install pyinstrument'.")
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            stats.profile = profiler
+    else:
+        raise ValueError("profile must be None, 'cprofile' or 'sampling'.")
+
+
+def profiled_thread(stats, func):
+    """func wrapped to run under a profiler of its own when the run is profiled with cProfile, for functions run in
+    other threads, which cProfile doesn't follow. Their profiles are added to stats.profile at the end of the run."""
+    if stats is None or stats._thread_profilers is None:
+        return func
+
+    import cProfile
+
+    def run(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # from Python 3.12 on cProfile is process-wide and the profiler of the run already sees this thread
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with stats._lock:
+                stats._thread_profilers.append(profiler)
+
+    return run
@@ -3,21 +3,127 @@
 Created on Tue Aug 24 16:50:27 2021
 
 @author: Tatu Leppämäki
+
+Writers for the geoparsing results. Each writer takes a DataFrame returned by geoparse (or an iterable of them,
+such as the chunks of geoparse_stream) and writes it to an open text file handle batch_size rows at a time, so the
+whole output is never built as one string in memory. The columns are read a batch at a time with tolist(), not row
+by row.
 """
 
 import json
 
+
+# the columns of a toponym that are included in the GeoJSON properties and the JSON lines, if present
+PROPERTY_COLUMNS = ('input_order', 'id', 'input_text', 'toponyms', 'topo_lemmas', 'topo_labels', 'topo_spans',
+                    'gid', 'layer', 'label', 'bbox')
+
+
+def dumps(obj):
+    # ids and such may be of types that JSON doesn't know, e.g. NumPy integers or timestamps
+    return json.dumps(obj, ensure_ascii=False, default=str)
+
+
+def iter_batches(results, columns, batch_size=10000):
+    """Input: a DataFrame or an iterable of DataFrames, the wanted columns and the number of rows in a batch.
+    Output: yields dictionaries of the columns present as lists of at most batch_size values. Missing values are None."""
+    import pandas as pd
+
+    if isinstance(results, pd.DataFrame):
+        results = [results]
+
+    for df in results:
+        present = [column for column in columns if column in df.columns]
+        for start in range(0, len(df), batch_size):
+            batch = df.iloc[start:start+batch_size]
+            yield {column: column_values(batch[column]) for column in present}
+
+
+def column_values(series):
+    """The values of a column as a list. The missing values of nullable columns, such as the Arrow-backed ones of
+    dtype_backend='pyarrow', are pd.NA, and they are turned into None like those of object columns."""
+    values = series.tolist()
+    if series.dtype != object and series.hasnans:
+        values = [None if missing else value for value, missing in zip(values, series.isna().tolist())]
+    return values
+
+
+def check_exploded(batch):
+    """EUPEG and GeoJSON have one entry per toponym, so the results must have one row per toponym."""
+    if any(isinstance(toponym, list) for toponym in batch.get('toponyms', [])):
+        raise ValueError("Write the results with one row per toponym (geoparse with explode_df=True).")
+
+
+def eupeg_records(batch):
+    """Input: a batch of columns from iter_batches.
+    Output: a list of EUPEG toponym dictionaries. Rows without toponyms are left out."""
+    check_exploded(batch)
+    coordinates = batch.get('coordinates') or [None] * len(batch['toponyms'])
+    return [{'start': span[0], 'end': span[1], 'phrase': toponym, 'place': {'footprint': footprint}}
+            for toponym, span, footprint in zip(batch['toponyms'], batch['topo_spans'], coordinates)
+            if toponym is not None]
+
+
 def create_eupeg_json(df):
     """Transforms a Pandas dataframe to a EUPEG json"""
-    filtered = df.reset_index()[['locations','loc_spans','coord_points']]
-    
-    all_toponyms = []
-    for i in range(len(filtered)):
-        row = filtered.iloc[i]
-        json_entry = {'start':row['loc_spans'][0], 'end':row['loc_spans'][1], 'phrase':row['locations'],
-                      'place':{'footprint':row['coord_points']}}
-        all_toponyms.append(json_entry)
-        
-    eupeg_dict = {'toponyms':all_toponyms}
-    
-    return json.dumps(eupeg_dict, ensure_ascii=False)
\ No newline at end of file
+    records = []
+    for batch in iter_batches(df, ('toponyms', 'topo_spans', 'coordinates')):
+        records.extend(eupeg_records(batch))
+
+    return dumps({'toponyms': records})
+
+
+def write_eupeg(results, f, batch_size=10000):
+    """Writes the results to the file handle f as a EUPEG JSON document, like create_eupeg_json."""
+    f.write('{"toponyms": [')
+    first = True
+    for batch in iter_batches(results, ('toponyms', 'topo_spans', 'coordinates'), batch_size):
+        records = eupeg_records(batch)
+        if records:
+            f.write(('' if first else ', ') + ', '.join(map(dumps, records)))
+            first = False
+    f.write(']}')
+
+
+def write_geojson(results, f, batch_size=10000):
+    """Writes the results to the file handle f as a GeoJSON FeatureCollection with a Point feature for each
+    geocoded toponym. The other columns of the toponym, such as the lemma, the span and the gid, are its properties.
+    Toponyms without coordinates are left out."""
+    f.write('{"type": "FeatureCollection", "features": [')
+    first = True
+    for batch in iter_batches(results, PROPERTY_COLUMNS + ('coordinates',), batch_size):
+        check_exploded(batch)
+        coordinates = batch.pop('coordinates', None)
+        if not coordinates:
+            continue
+
+        names = list(batch)
+        features = [dumps({'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': point},
+                           'properties': dict(zip(names, values))})
+                    for point, *values in zip(coordinates, *batch.values()) if point is not None]
+        if features:
+            f.write(('' if first else ', ') + ', '.join(features))
+            first = False
+    f.write(']}')
+
+
+def write_jsonl(results, f, batch_size=10000):
+    """Writes each row of the results to the file handle f as a line of JSON. Works with both one row per toponym
+    and one row per text (explode_df=False), in which case the toponym columns are lists."""
+    for batch in iter_batches(results, PROPERTY_COLUMNS + ('toponyms_found', 'coordinates'), batch_size):
+        names = list(batch)
+        f.write(''.join(dumps(dict(zip(names, values))) + '\n' for values in zip(*batch.values())))
+
+
+WRITERS = {'eupeg': write_eupeg, 'geojson': write_geojson, 'jsonl': write_jsonl}
+
+
+def write_results(results, path_or_file, output_format, batch_size=10000):
+    """Writes the results in output_format ('eupeg', 'geojson' or 'jsonl') to a path or an open text file handle."""
+    if output_format not in WRITERS:
+        raise ValueError("output_format must be 'eupeg', 'geojson' or 'jsonl'.")
+
+    if isinstance(path_or_file, str):
+        with open(path_or_file, 'w', encoding='utf-8') as f:
+            WRITERS[output_format](results, f, batch_size)
+    else:
+        WRITERS[output_format](results, path_or_file, batch_size)
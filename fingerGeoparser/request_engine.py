@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Sends the geocoder's HTTP requests with retries, backoff and a concurrency limit that adapts to the service.
+"""
+
+import asyncio, random, time
+
+
+# statuses worth retrying: rate limiting and temporary server-side errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class request_engine:
+    """
+    Sends a large number of GET requests to a single endpoint (in practice, the geocoder) with a bounded
+    work queue, retries and an adaptive concurrency limit.
+
+    The concurrency limit follows AIMD (additive increase, multiplicative decrease): it grows slowly while
+    the requests succeed and the latency stays close to the best latency seen so far, and is halved when
+    the server returns errors (e.g. 429 Too Many Requests) or the latency grows too much.
+
+    Parameters:
+        max_concurrency | Int: The upper limit of concurrent requests. Default 15.
+
+        min_concurrency | Int: The lower limit of concurrent requests. Default 1.
+
+        max_retries | Int: How many times a failed request is retried. Default 3.
+
+        backoff_base | Float: Seconds to wait before the first retry. The wait doubles with each retry and has
+                              random jitter added to it. Default 0.5.
+
+        backoff_max | Float: Maximum seconds to wait between retries. Default 10.
+
+        timeout | Float: Timeout of a single request in seconds. Default 10.
+
+        latency_tolerance | Float: How many times the best seen latency is tolerated before the concurrency
+                                   is decreased. Default 3.
+    """
+
+    def __init__(self, max_concurrency=15, min_concurrency=1, max_retries=3, backoff_base=0.5, backoff_max=10,
+                 timeout=10, latency_tolerance=3):
+        assert 1 <= min_concurrency <= max_concurrency, "Concurrency limits must satisfy 1 <= min <= max."
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.latency_tolerance = latency_tolerance
+
+        self.concurrency = float(max_concurrency)
+        self.loads = json_loads()
+        self._slots = None
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.in_flight = 0
+        self._best_latency = None
+        self._latency = None
+        self._last_decrease = 0.0
+
+    def stats(self):
+        """Returns the request counters and the current concurrency limit as a dictionary."""
+        return {'sent': self.sent, 'retried': self.retried, 'failed': self.failed, 'in_flight': self.in_flight,
+                'concurrency': int(self.concurrency)}
+
+    async def fetch_all(self, session, url, queries, on_done=None, stats=None):
+        """Requests the url once per query (a dictionary of URL parameters).
+
+        Input:
+            session | aiohttp.ClientSession: the session used for the requests.
+            url | String: the requested url.
+            queries | List of dictionaries: the URL parameters of each request.
+            on_done | Callable, optional: called without arguments after each finished query, e.g. to update a progress bar.
+            stats | geoparse_stats, optional: records the requests, retries, errors and latencies.
+
+        Output: a list of the decoded JSON responses in the order of the queries. Failed requests are None."""
+        results = [None] * len(queries)
+        # the queue holds only a limited number of waiting queries instead of a future for every query
+        queue = asyncio.Queue(maxsize=2 * self.max_concurrency)
+
+        # the concurrency limit is shared by all the batches running on the same event loop
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Condition()
+            self._slots_loop = loop
+            self.in_flight = 0
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                i, params = item
+                results[i] = await self.fetch(session, url, params, stats=stats)
+                if on_done:
+                    on_done()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.max_concurrency)]
+        try:
+            for item in enumerate(queries):
+                await queue.put(item)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+
+        return results
+
+    async def fetch(self, session, url, params, stats=None):
+        """Requests the url with the parameters, retrying with exponential backoff. Returns the decoded JSON or None.
+        If stats are given, the attempts are counted and the latencies of the successful ones recorded."""
+        import aiohttp
+
+        for attempt in range(self.max_retries + 1):
+            await self._acquire()
+            start = time.monotonic()
+            retry_after = None
+            try:
+                self.sent += 1
+                if stats is not None:
+                    stats.count('http_requests')
+                async with session.get(url, params=params, timeout=aiohttp.ClientTimeout(total=self.timeout)) as response:
+                    if response.status == 200:
+                        # decoding the raw bytes skips decoding them to a string first
+                        data = self.loads(await response.read())
+                        latency = time.monotonic() - start
+                        self._on_success(latency)
+                        if stats is not None:
+                            stats.observe('geocoder_latency', latency)
+                        return data
+                    if response.status not in RETRY_STATUSES:
+                        # e.g. a malformed query, retrying won't help
+                        print(url, params, response.status)
+                        if stats is not None:
+                            stats.count('http_errors')
+                        break
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                # connection problems, timeouts and broken JSON are retried
+                pass
+            finally:
+                await self._release()
+
+            self._on_error()
+            if stats is not None:
+                stats.count('http_errors')
+            if attempt < self.max_retries:
+                self.retried += 1
+                if stats is not None:
+                    stats.count('http_retries')
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        self.failed += 1
+        if stats is not None:
+            stats.count('http_failures')
+        return None
+
+    def _backoff(self, attempt, retry_after=None):
+        """Exponential backoff with full jitter. A numeric Retry-After header given by the server is respected."""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        if retry_after:
+            try:
+                delay = max(delay, min(self.backoff_max, float(retry_after)))
+            except ValueError:
+                pass
+        return delay
+
+    async def _acquire(self):
+        async with self._slots:
+            while self.in_flight >= int(self.concurrency):
+                await self._slots.wait()
+            self.in_flight += 1
+
+    async def _release(self):
+        async with self._slots:
+            self.in_flight -= 1
+            self._slots.notify_all()
+
+    def _on_success(self, latency):
+        self._best_latency = latency if self._best_latency is None else min(self._best_latency, latency)
+        # exponentially weighted moving average of the latency
+        self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+
+        if self._latency > self.latency_tolerance * self._best_latency:
+            self._decrease()
+        else:
+            # additive increase: about one more concurrent request per round of successful requests
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def _on_error(self):
+        self._decrease()
+
+    def _decrease(self):
+        """Multiplicative decrease, at most once per (average) round trip so that a burst of errors counts once."""
+        now = time.monotonic()
+        if now - self._last_decrease < (self._latency or 0):
+            return
+        self._last_decrease = now
+        self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+
+
+def json_loads():
+    """Returns orjson.loads, which is several times faster, if orjson is installed, and json.loads if not."""
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        import json
+        return json.loads
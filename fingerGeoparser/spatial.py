@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial post-processing of the geocoding results: choosing between the candidate locations of ambiguous toponyms
+by the other toponyms of the same text, and filtering the results by a bounding box or a polygon. Everything runs
+on NumPy arrays, so that results of millions of rows are handled in seconds. Shapely is only needed for filtering
+with Shapely polygons.
+"""
+
+import numpy as np
+
+
+EARTH_RADIUS = 6371.0
+
+# the distance used for candidates without coordinates, longer than any distance on Earth
+NO_DISTANCE = 2 * np.pi * EARTH_RADIUS
+
+
+def to_lonlats(coordinates):
+    """Input: a list (or a Series) of [lon, lat] pairs or Nones.
+    Output: a (n, 2) float array with NaNs for the Nones."""
+    nan = (np.nan, np.nan)
+    return np.array([point if point is not None else nan for point in coordinates], dtype=float).reshape(-1, 2)
+
+
+def disambiguate(counts, lemmas, results, rank_weight=50.0, block_size=2000000):
+    """
+    Chooses a location for each toponym from its candidates (see 'candidates' in toponym_coder), based on the other
+    toponyms in the same text. A candidate is scored by its mean distance to the closest candidate of each of the
+    other toponyms, so that e.g. 'Lahti' and 'Hollola' in the same text favour the Lahti next to Hollola. A candidate
+    whose label names another toponym of the text, like 'Espoo, Uusimaa, Finland' when 'Uusimaa' is mentioned,
+    is considered to be at zero distance from it. Every step down in the geocoder's ranking adds rank_weight
+    kilometres to the score, so the geocoder's first choice is only overridden when the context clearly disagrees.
+    Toponyms alone in their text keep the first candidate.
+
+    The values of the chosen candidates replace those of the first candidates in results, and the 'candidates'
+    column is removed. The candidates of a lemma are assumed to be the same wherever it occurs, as geocode_toponyms
+    returns them, so they are only read once per lemma.
+
+    Input:
+        counts | Sequence of ints: the number of toponyms in each text (tag_buffer.counts).
+
+        lemmas | List of strings: the lemma of each toponym.
+
+        results | Dictionary of lists: the geocoding results of the toponyms with a 'candidates' column, as
+                                      geocode_toponyms returns them. Must include 'coordinates'.
+
+        rank_weight | Float: Kilometres added to the score of a candidate per step down in the ranking. Default 50.
+
+        block_size | Int: How many pairs of candidates are compared at once. Each candidate is paired with every
+                          candidate of its text, and a block holds the pairs of as many candidates as fit, but at
+                          least one. Bounds the memory use. Default 2000000.
+
+    Output: the number of toponyms whose location changed.
+    """
+    candidates = results.pop('candidates')
+    columns = list(results)
+
+    counts = np.asarray(counts, dtype=np.int64)
+    text_of = np.repeat(np.arange(len(counts)), counts)
+
+    # only toponyms that have several candidates and share their text with other found toponyms can change
+    found = np.fromiter((bool(c) for c in candidates), dtype=bool, count=len(candidates))
+    found_per_text = np.bincount(text_of[found], minlength=len(counts))
+    toponym_index = np.flatnonzero(found & (found_per_text[text_of] > 1))
+    if not any(len(candidates[j]) > 1 for j in toponym_index.tolist()):
+        return 0
+
+    # the candidates of each distinct lemma in a flat table
+    lemma_ids = {}
+    topo_lemma = np.array([lemma_ids.setdefault(lemma, len(lemma_ids)) for lemma in lemmas], dtype=np.int64)
+    unique, first = np.unique(topo_lemma[toponym_index], return_index=True)
+    table = [candidate for j in toponym_index[first].tolist() for candidate in candidates[j]]
+    lemma_sizes = np.zeros(len(lemma_ids), dtype=np.int64)
+    lemma_sizes[unique] = [len(candidates[j]) for j in toponym_index[first].tolist()]
+    lemma_offsets = np.cumsum(lemma_sizes) - lemma_sizes
+    points = unit_vectors(to_lonlats([candidate[columns.index('coordinates')] for candidate in table]))
+
+    # the candidates of the toponyms, in the order of the toponyms (and so, of the texts)
+    sizes = lemma_sizes[topo_lemma[toponym_index]]
+    cand_topo = np.repeat(toponym_index, sizes)
+    cand_rank = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    cand_table = lemma_offsets[topo_lemma[cand_topo]] + cand_rank
+    cand_text = text_of[cand_topo]
+    text_start = np.searchsorted(cand_text, cand_text, side='left')
+    text_size = np.searchsorted(cand_text, cand_text, side='right') - text_start
+
+    # the distance of each candidate 'a' to the closest candidate of each other toponym in its text
+    key_a, key_topo, closest = [], [], []
+    pairs_before = np.cumsum(text_size) - text_size
+    start = 0
+    while start < len(cand_topo):
+        end = max(np.searchsorted(pairs_before, pairs_before[start] + block_size, side='left'), start + 1)
+        a = np.arange(start, end)
+        start = end
+        sizes = text_size[a]
+        b = np.repeat(text_start[a], sizes) + (np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes))
+        a = np.repeat(a, sizes)
+        other = cand_topo[a] != cand_topo[b]
+        a, b = a[other], b[other]
+
+        # squared chord lengths between unit vectors order the points like great-circle distances, but are cheaper
+        chords = points[cand_table[a]] - points[cand_table[b]]
+        chords = np.einsum('ij,ij->i', chords, chords)
+        # the pairs are ordered by 'a' and then by the toponym of 'b', so the groups are consecutive
+        keys = a * len(lemmas) + cand_topo[b]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        key_a.append(a[starts])
+        key_topo.append(cand_topo[b[starts]])
+        closest.append(np.fmin.reduceat(chords, starts))
+
+    key_a, key_topo, closest = np.concatenate(key_a), np.concatenate(key_topo), np.concatenate(closest)
+    closest = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(closest, 0, 4)) / 2)
+    closest[np.isnan(closest)] = NO_DISTANCE
+
+    # co-occurrence: a candidate labelled with the name of another toponym of the text is within it. The parts of
+    # the labels that are lemmas of some toponym are looked up once per candidate of each lemma
+    if 'label' in results:
+        label_index = columns.index('label')
+        named = [(i, lemma_ids[part]) for i, candidate in enumerate(table) if candidate[label_index]
+                 for part in candidate[label_index].split(', ') if part in lemma_ids]
+        if named:
+            named = np.array(named, dtype=np.int64)
+            pair_lemma = topo_lemma[key_topo]
+            within = np.isin(cand_table[key_a] * len(lemma_ids) + pair_lemma, named[:, 0] * len(lemma_ids) + named[:, 1])
+            closest[within & (pair_lemma != topo_lemma[cand_topo[key_a]])] = 0.0
+
+    n_others = np.bincount(key_a, minlength=len(cand_topo))
+    scores = np.bincount(key_a, weights=closest, minlength=len(cand_topo)) / np.maximum(n_others, 1)
+    scores += rank_weight * cand_rank
+
+    # the best scoring candidate of each toponym
+    order = np.lexsort((scores, cand_topo))
+    first = order[np.r_[True, cand_topo[order][1:] != cand_topo[order][:-1]]]
+    changed = first[cand_rank[first] > 0]
+
+    for cand in changed.tolist():
+        values = candidates[cand_topo[cand]][cand_rank[cand]]
+        for column, value in zip(columns, values):
+            results[column][cand_topo[cand]] = value
+    return len(changed)
+
+
+def unit_vectors(lonlats):
+    """Converts WGS84 points to 3D unit vectors."""
+    lons, lats = np.radians(lonlats[:, 0]), np.radians(lonlats[:, 1])
+    # single precision is accurate to some metres, which is plenty for telling candidates apart
+    return np.column_stack((np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats))).astype(np.float32)
+
+
+def points_in_polygon(lons, lats, polygon):
+    """Input: arrays of points and the exterior ring of a polygon as a list of (lon, lat).
+    Output: a boolean array of whether each point is inside the polygon (even-odd rule)."""
+    ring = np.asarray(polygon, dtype=float)
+    inside = np.zeros(len(lons), dtype=bool)
+    x1, y1 = ring[-1]
+    for x2, y2 in ring:
+        # the edges that a ray going east from the point crosses
+        crosses = (y1 > lats) != (y2 > lats)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x_cross = x1 + (lats - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (lons < x_cross)
+        x1, y1 = x2, y2
+    return inside
+
+
+class spatial_index:
+    """
+    An index of the points of geocoded toponyms for fast bounding box and polygon queries. The points are kept
+    sorted by longitude, so a query only looks at the points within its longitude range.
+
+    Parameters:
+        coordinates | List or Series: [lon, lat] pairs or Nones, e.g. the 'coordinates' column of the results
+                                      of geoparse with one row per toponym.
+    """
+
+    def __init__(self, coordinates):
+        lonlats = to_lonlats(coordinates)
+        valid = np.flatnonzero(~np.isnan(lonlats).any(axis=1))
+        self.order = valid[np.argsort(lonlats[valid, 0], kind='stable')]
+        self.lons = lonlats[self.order, 0]
+        self.lats = lonlats[self.order, 1]
+
+    def __len__(self):
+        return len(self.order)
+
+    def query_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Output: the sorted positions of the points within the bounding box (edges included)."""
+        start = np.searchsorted(self.lons, min_lon, side='left')
+        end = np.searchsorted(self.lons, max_lon, side='right')
+        within = (self.lats[start:end] >= min_lat) & (self.lats[start:end] <= max_lat)
+        return np.sort(self.order[start:end][within])
+
+    def query_polygon(self, polygon):
+        """Input: a Shapely polygon (requires Shapely 2) or the exterior ring of one as a list of (lon, lat).
+        Output: the sorted positions of the points within the polygon."""
+        if hasattr(polygon, 'bounds'):
+            import shapely
+            min_lon, min_lat, max_lon, max_lat = polygon.bounds
+        else:
+            ring = np.asarray(polygon, dtype=float)
+            (min_lon, min_lat), (max_lon, max_lat) = ring.min(axis=0), ring.max(axis=0)
+
+        # only the points in the bounding box of the polygon are tested
+        start = np.searchsorted(self.lons, min_lon, side='left')
+        end = np.searchsorted(self.lons, max_lon, side='right')
+        lons, lats = self.lons[start:end], self.lats[start:end]
+        in_box = (lats >= min_lat) & (lats <= max_lat)
+        lons, lats, positions = lons[in_box], lats[in_box], self.order[start:end][in_box]
+
+        if hasattr(polygon, 'bounds'):
+            inside = shapely.contains_xy(polygon, lons, lats)
+        else:
+            inside = points_in_polygon(lons, lats, polygon)
+        return np.sort(positions[inside])
+
+
+def filter_results(df, bbox=None, polygon=None, column='coordinates'):
+    """
+    Keeps the rows of the results whose location is within a bounding box and/or a polygon.
+
+    Input:
+        df | DataFrame: the results of geoparse with one row per toponym (explode_df=True).
+
+        bbox | Tuple: (min_lon, min_lat, max_lon, max_lat) in WGS84. Default None.
+
+        polygon | Shapely polygon or list of (lon, lat): Default None.
+
+        column | String: the column of the points. Default 'coordinates'.
+
+    Output: a DataFrame of the rows within the area, in the original order.
+    """
+    if bbox is None and polygon is None:
+        raise ValueError("Provide a bbox, a polygon or both.")
+    if any(isinstance(point, list) and point and isinstance(point[0], list) for point in df[column].head(100)):
+        raise ValueError("Filter the results with one row per toponym (geoparse with explode_df=True).")
+
+    index = spatial_index(df[column].tolist())
+    positions = index.query_bbox(*bbox) if bbox is not None else None
+    if polygon is not None:
+        in_polygon = index.query_polygon(polygon)
+        positions = in_polygon if positions is None else np.intersect1d(positions, in_polygon, assume_unique=True)
+    return df.iloc[positions]
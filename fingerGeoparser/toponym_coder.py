@@ -6,10 +6,13 @@ Created on Wed Mar 24 18:53:37 2021
 """
 
 #import pandas as pd
-import requests
-import aiohttp
-import asyncio
-from tqdm.asyncio import tqdm
+import asyncio, threading
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+# aiohttp and tqdm are imported when the first batch is geocoded to keep the startup fast
+from fingerGeoparser.cache import persistent_cache
+from fingerGeoparser.request_engine import request_engine
 
 #try:
 #    from shapely.geometry import Point
@@ -19,48 +22,108 @@ from tqdm.asyncio import tqdm
 
 class toponym_coder:
     
-    def __init__(self, geocoder_url="http://vm5121.kaj.pouta.csc.fi:4000/v1/"):
+    def __init__(self, geocoder_url="http://vm5121.kaj.pouta.csc.fi:4000/v1/", cache_path=None,
+                 cache_ttl=None, cache_max_entries=None, max_concurrency=15, max_retries=3, timeout=10,
+                 health_check='background', progress=True, result_size=1, layers=None):
         """
         Calls a geocoder at the defined URL and returns a dictionary of responses.
+
+        Each unique toponym is requested only once per batch, and the result is copied to every row it occurs on.
+        Optionally, the results are also kept in a persistent cache (a SQLite file) between runs.
+
+        Parameters:
+            geocoder_url | String: URL of a running Pelias geocoder.
+
+            cache_path | String: Path to a SQLite file where the geocoding results are cached. Default None (no persistent cache).
+
+            cache_ttl | Float: How many seconds a cached result is considered valid. Default None (forever).
+
+            cache_max_entries | Int: Maximum number of cached results. The least recently used ones are evicted first.
+                                     Default None (no limit).
+
+            max_concurrency | Int: Maximum number of concurrent requests to the geocoder. The actual number adapts
+                                   to the latency and errors of the geocoder. Default 15.
+
+            max_retries | Int: How many times a failed request (e.g. 429 or 502 status, or a timeout) is retried. Default 3.
+
+            timeout | Float: Timeout of a single request in seconds. Default 10.
+
+            health_check | String or Boolean: How the geocoder is checked to be up. 'background' (default) checks it in
+                                              a background thread and prints a warning if it's not. 'sync' (or True)
+                                              checks it right away and raises an AssertionError if it's not. False skips the check.
+
+            progress | Boolean: Whether a progress bar is shown while geocoding. Default True.
+
+            result_size | Int: How many results the geocoder returns per toponym. Only the first one is used, unless
+                               the 'candidates' column is requested, so asking for more only makes the responses
+                               bigger. Default 1.
+
+            layers | String or List of strings: The Pelias layers to search from, e.g. ['locality', 'region'] or
+                                                'coarse'. Limits the results and makes the searches lighter.
+                                                Default None (all layers).
         """
 
         self.geocoder_url = geocoder_url
         assert self.geocoder_url, "A valid URL pointing to a running Pelias geocoding service must be provided."
-        
-        params = {'text':'Kamppi'}
-        res = requests.get(geocoder_url+'search', params=params)
-        assert res.status_code == 200, f"Geocoder from url {geocoder_url} did not return all OK. The path could be faulty or the service unavailable."
 
-    async def geocode_toponyms(self, toponyms, columns=['coordinates', 'gid', 'layer', 'label', 'bbox'], params=None):
+        # None until the health check has finished
+        self.healthy = None
+        if health_check in (True, 'sync'):
+            assert self.check_health(), f"Geocoder from url {geocoder_url} did not return all OK. The path could be faulty or the service unavailable."
+        elif health_check == 'background':
+            threading.Thread(target=self.check_health, kwargs={'warn': True}, daemon=True).start()
+        elif health_check:
+            raise ValueError("health_check must be 'background', 'sync', True or False.")
+
+        self.progress = progress
+
+        # sent with every query, unless overridden with the params of geocode_toponyms
+        self.query_params = {'size': result_size}
+        if layers:
+            self.query_params['layers'] = layers if isinstance(layers, str) else ','.join(layers)
+
+        self.engine = request_engine(max_concurrency=max_concurrency, max_retries=max_retries, timeout=timeout)
+
+        # a long-lived HTTP session for each event loop, see open_session
+        self._sessions = {}
+
+        if cache_path:
+            self.cache = persistent_cache(cache_path, ttl=cache_ttl, max_entries=cache_max_entries)
+        else:
+            self.cache = None
+
+    def check_health(self, timeout=5, warn=False):
+        """Makes a test query to the geocoder. Returns whether it answered all OK, and optionally prints a warning if not."""
+        try:
+            with urlopen(self.geocoder_url + 'search?' + urlencode({'text': 'Kamppi'}), timeout=timeout) as res:
+                self.healthy = res.status == 200
+        except (OSError, ValueError):
+            self.healthy = False
+
+        if warn and not self.healthy:
+            print(f"Geocoder from url {self.geocoder_url} did not return all OK. The path could be faulty or the service unavailable.")
+        return self.healthy
+
+    async def geocode_toponyms(self, toponyms, columns=['coordinates', 'gid', 'layer', 'label', 'bbox'], params=None, stats=None):
         """Input: a list of toponyms: in default operation, this is a lemmatized versions of the toponyms recognized in the previous step.
         TODO: EXPAND WITH COLUMNS AND PARAMS
         Outputs: 
         	UPDATE
             Lonlats - list of coordinates in WGS84 longitude-latitude format
             Labels - Textual descriptions of the toponym as returned by the geocoder
-            GIDS - An unique label that internally identifies the location. These are not stable and can change as the data in the geocoder is updated."""
+            GIDS - An unique label that internally identifies the location. These are not stable and can change as the data in the geocoder is updated.
+        If a geoparse_stats object is given as stats, the unique toponyms, cache hits and requests are recorded in it."""
 
         lists = {key: list() for key in columns}
 
-        responses = await self.batch_get(toponyms, params=params)
-
-        for response in responses:
-            # for each response, check if the returned something (if it failed, it will not have 'features'). NB! The status will still be 200 for empty responses
-            if response and response['features']:
-
-                for key in lists.keys():
-                    # loop through the requested columns, append values
-                    # because the keys may not be at the base level, I need to do this clumsy hardcode for acquiring the correct values
-
-                    # related to geometry
-                    if key in ('type', 'coordinates'):
-                        lists[key].append(response['features'][0]['geometry'][key])
-                    # if not, it's probably at the properties level
-                    elif key != 'bbox':
-                        lists[key].append(response['features'][0]['properties'][key])
-                    # else a bounding box, which is at the base level
-                    else:
-                        lists[key].append(response['features'][0][key])
+        # resolve each unique toponym only once, the results are then fanned out to the rows
+        resolved = await self.resolve_unique(toponyms, columns=columns, params=params, stats=stats)
+
+        for toponym in toponyms:
+            values = resolved.get(toponym) if toponym else None
+            if values:
+                for key, value in zip(columns, values):
+                    lists[key].append(value)
             else:
                 # if nothing was returned, appends Nones to all lists
                 for this_list in lists.values():
@@ -68,41 +131,134 @@ class toponym_coder:
 
         return lists
 
-    async def batch_get(self, topos, params=None):
-        """"This function forms the query urls, which are then asynchronoysly requested from the geocoder"""
-        # avoid badgering the server with too many requests at once -> leads to http errors
-        # this limits the concurrent connections to 15 (default 100)
-        connector = aiohttp.TCPConnector(limit=15)
-
-        async with aiohttp.ClientSession(connector=connector) as session:
-            tasks = []
-            for topo in topos:
-                if topo:
-                    # if there's a lemmatized toponym, try searching with that. If not, return an empty string
-                    url = f"{self.geocoder_url}search"
-                    if params:
-                    	url_params = {'text': topo, **params}
-                    else:
-                        url_params = {'text': topo}
-                    task = asyncio.ensure_future(self.get_response(session, url, params=url_params))
-                    tasks.append(task)
-                else:
-                    task = asyncio.ensure_future(self.return_none())
-                    tasks.append(task)
-            # tqdm.gather works as a wrapper for asyncio.gather: it adds a progress bar
-            responses = await tqdm.gather(*tasks, desc="Geocoding...")
-
-            return responses
-
-    async def get_response(self, session, url, params=None):
-        """Setup one request. If the response code is something other than 200, print the error code."""
-        async with session.get(url, params=params) as response:
-            if response.status != 200:
-                print(url, response.status)
-            return await response.json()
-        
-    async def return_none(self):
-        return ""
+    async def resolve_unique(self, toponyms, columns=['coordinates', 'gid', 'layer', 'label', 'bbox'], params=None, stats=None):
+        """Geocodes the unique, non-empty toponyms of the input. Results found in the persistent cache are not requested again.
+        Output: a dictionary of toponyms and lists of values in the order of 'columns', or None if the geocoder found nothing."""
+        unique = list(dict.fromkeys(topo for topo in toponyms if topo))
+        params = {**self.query_params, **params} if params else self.query_params
+
+        resolved = {}
+        if self.cache is not None:
+            keys = {topo: self.cache.make_key(topo, params, columns) for topo in unique}
+            cached = self.cache.get_many(list(keys.values()))
+            for topo in unique:
+                if keys[topo] in cached:
+                    resolved[topo] = cached[keys[topo]]
+
+        missing = [topo for topo in unique if topo not in resolved]
+        if stats is not None:
+            stats.count('unique_lemmas', len(unique))
+            if self.cache is not None:
+                stats.count('cache_hits', len(unique) - len(missing))
+                stats.count('cache_misses', len(missing))
+
+        responses = await self.batch_get(missing, params=params, stats=stats)
+
+        to_cache = {}
+        for topo, response in zip(missing, responses):
+            values = self.parse_response(response, columns)
+            resolved[topo] = values
+            # failed requests are not cached, only successful responses (which may have zero features)
+            if self.cache is not None and self.is_valid_response(response):
+                to_cache[keys[topo]] = values
+
+        if to_cache:
+            self.cache.set_many(to_cache)
+
+        return resolved
+
+    def parse_response(self, response, columns):
+        """Picks the requested columns from the first feature of a Pelias response. Returns None if there were no features.
+        The 'candidates' column holds the values of the other columns for every feature of the response, for
+        choosing between them afterwards (see spatial.disambiguate)."""
+        # for each response, check if the returned something (if it failed, it will not have 'features'). NB! The status will still be 200 for empty responses
+        if not (response and response.get('features')):
+            return None
+
+        values = self.feature_values(response['features'][0], columns)
+        if 'candidates' in columns:
+            others = [key for key in columns if key != 'candidates']
+            values[columns.index('candidates')] = [self.feature_values(feature, others)
+                                                   for feature in response['features']]
+        return values
+
+    @staticmethod
+    def feature_values(feature, columns):
+        """The values of the requested columns of a single Pelias feature."""
+        values = []
+        for key in columns:
+            # loop through the requested columns, append values
+            # because the keys may not be at the base level, I need to do this clumsy hardcode for acquiring the correct values
+
+            # related to geometry
+            if key in ('type', 'coordinates'):
+                values.append(feature['geometry'][key])
+            # filled in by parse_response
+            elif key == 'candidates':
+                values.append(None)
+            # if not, it's probably at the properties level
+            elif key != 'bbox':
+                values.append(feature['properties'].get(key))
+            # else a bounding box, which is at the base level. Points don't have one
+            else:
+                values.append(feature.get(key))
+        return values
+
+    @staticmethod
+    def is_valid_response(response):
+        """Whether the response is a proper Pelias answer, as opposed to a failed request or an error message."""
+        return isinstance(response, dict) and 'features' in response and not response.get('geocoding', {}).get('errors')
+
+    async def open_session(self):
+        """Returns the aiohttp session of the running event loop, creating it on first use. The session and its
+        connections are reused by all the batches geocoded on the same loop until aclose() is awaited."""
+        import aiohttp
+
+        loop = asyncio.get_running_loop()
+        # sessions of loops that have been closed since can't be used (or closed) anymore
+        for old_loop in [old_loop for old_loop in self._sessions if old_loop.is_closed()]:
+            del self._sessions[old_loop]
+
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            # the request engine limits the concurrent requests and adapts the limit to the server's responses.
+            # The connections are kept alive between the requests (and batches), so that they aren't reopened
+            connector = aiohttp.TCPConnector(limit=self.engine.max_concurrency, keepalive_timeout=60)
+            session = self._sessions[loop] = aiohttp.ClientSession(connector=connector)
+        return session
+
+    async def aclose(self):
+        """Closes the session of the running event loop, if there is one."""
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    async def batch_get(self, topos, params=None, stats=None):
+        """"This function forms the query urls, which are then asynchronoysly requested from the geocoder.
+        Failed requests (after retries) and empty toponyms return None."""
+        from tqdm import tqdm
+
+        session = await self.open_session()
+        url = f"{self.geocoder_url}search"
+        # if there's a lemmatized toponym, try searching with that. If not, the result is None
+        queried = [i for i, topo in enumerate(topos) if topo]
+        params = params if params is not None else self.query_params
+        queries = [{'text': topos[i], **params} for i in queried]
+
+        failed_before = self.engine.failed
+        with tqdm(total=len(queries), desc="Geocoding...", disable=not self.progress) as progress:
+            responses = await self.engine.fetch_all(session, url, queries, on_done=progress.update, stats=stats)
+
+        failed = self.engine.failed - failed_before
+        if failed:
+            print(failed, "geocoder requests failed after retries. Their toponyms were left without results.")
+
+        results = [None] * len(topos)
+        for i, response in zip(queried, responses):
+            results[i] = response
+
+        return results
+
 """
     def form_point(self, gn_result):
         if self.shp_points:
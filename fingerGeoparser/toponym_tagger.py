@@ -6,9 +6,43 @@ Created on Wed Mar 24 18:51:53 2021
 """
 
 
-import spacy, pandas as pd, re
+import hashlib, re, threading, time
 
-from tqdm import tqdm
+from array import array
+from contextlib import nullcontext
+from itertools import chain
+
+from fingerGeoparser import cache
+from fingerGeoparser.metrics import timed
+
+# Spacy, Pandas, NumPy and tqdm are imported where they are used, so that importing
+# the module (and creating a tagger) stays fast. The pipeline is loaded on first use.
+
+
+# named entities are needed in any case, and their lemmas are built from the token lemmas
+ENTITY_ATTRS = ('doc.ents', 'token.ent_iob', 'token.ent_type')
+POS_ATTRS = ('token.pos', 'token.tag', 'token.morph')
+EMBEDDING_FACTORIES = ('transformer', 'tok2vec')
+
+# columns converted to Arrow strings with dtype_backend='pyarrow'
+STRING_COLUMNS = ('input_text', 'toponyms', 'topo_lemmas', 'topo_labels', 'gid', 'layer', 'label')
+
+# the noise removed by preprocess_sent, all in one pass: mentions (@xyz), URLs, ampersands (possibly followed by 'amp'),
+# old school hearts <3 and hashes of hashtags (but not the tags themselves). Optionally also emojis: pictographs,
+# symbols and dingbats, flags, and the variation selectors, joiners and tags emoji sequences are built from
+EMOJIS = '\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF\uFE0E\uFE0F\u200D\U000E0020-\U000E007F'
+NOISE = r'@\S+ *|https?://\S+|&(?:amp)?|<3|#'
+NOISE_PATTERN = re.compile(NOISE)
+NOISE_AND_EMOJI_PATTERN = re.compile(NOISE + '|[' + EMOJIS + ']+')
+
+# characters removed from the lemmas. Hashes mark word boundaries in compound words, and with filtering, punctuation
+# (including various quotation marks) captured by the tagger is removed as well
+HASH_TABLE = str.maketrans('', '', '#')
+LEMMA_TABLE = str.maketrans('', '', '#.?!;:\'"“”‘’')
+
+# words, and the ends of sentences, where over-long texts are preferably split
+WORD_PATTERN = re.compile(r'\S+')
+SENTENCE_END_PATTERN = re.compile(r'[.!?…]["”’)]*$')
 
 
 class toponym_tagger:
@@ -30,23 +64,193 @@ class toponym_tagger:
         output_df | Boolean: If True, the output will be a Pandas DataFrame. If False, a dictionary.
                             Currently, False does nothing. Left in if newer versions implement something
                             other than Pandas (just nested dictionaries?)
+
+        n_process | Int: Number of worker processes used to run the pipeline. Each worker gets its own copy
+                         of the pipeline, which is loaded once per worker. -1 uses all CPU cores. Default 1.
+                         With several processes, it's recommended to limit the threads of each worker,
+                         e.g. with the environment variable OMP_NUM_THREADS=1. Ignored on the GPU.
+
+        batch_size | Int: How many texts the pipeline processes at once. Default None (the pipeline's own default).
+
+        pipeline_mode | String: 'full' runs every component of the pipeline. 'lean' disables the components
+                                that aren't needed for recognizing and lemmatizing toponyms, such as the
+                                dependency parser. Default 'full'.
+
+        dtype_backend | String: None (default) returns regular NumPy-backed columns. 'pyarrow' returns the
+                                text columns as Arrow-backed strings (or lists of strings), if pyarrow is installed.
+
+        progress | Boolean: Whether progress bars are shown while tagging. Default True.
+
+        lemma_memo | cache.lemma_memo or Boolean: Memoizes the lemmas of the toponyms by their surface forms, so that
+                                                 forms seen before aren't lemmatized and cleaned again. True creates
+                                                 a memo of 100000 forms. Pass a lemma_memo to share it between taggers
+                                                 or to save it between runs. Default None (no memo).
+
+        lemmatize_on_miss | Boolean: With a lemma memo, leaves the lemmatizer out of the pipeline and runs it only on
+                                     the texts with toponyms that aren't memoized. Pays off with a lemmatizer that
+                                     is slow compared to the rest of the pipeline. Default False.
+
+        deduplicate | Boolean: Runs each distinct text through the pipeline only once and copies its toponyms to the
+                               duplicates (retweets, copy-pasted posts and such). Default False.
+
+        text_cache | String or cache.persistent_cache: An SQLite file (or a cache object) where the toponyms of each
+                                                       text are kept between runs, keyed by a hash of the text, the
+                                                       pipeline and the tagging settings. Texts found in it aren't
+                                                       tagged again. Implies deduplicate. Default None.
+
+        token_budget | Int: Sorts the texts by length and forms the batches by the number of tokens in them (including
+                            the padding to the longest text of the batch) instead of by a fixed number of texts, so
+                            that short texts aren't padded to the length of long ones. The tokens are estimated as
+                            words. The results keep the input order. With several processes, the sorted texts are
+                            fed to the pipeline in batches of batch_size. Default None (arrival order).
+
+        max_text_tokens | Int: With a token_budget, texts longer than this many words are split into windows at
+                               sentence boundaries (or, failing those, between words) and tagged window by window.
+                               The spans are mapped back to the whole text. Default 512.
+
+        The pipeline isn't loaded when the tagger is created, but when it's first needed. Call warm_up() to
+        load it in the background beforehand.
         """
     
         
     def __init__(self, pipeline_path="fi_geoparser", use_gpu=True, 
-                 output_df=True):
-        if use_gpu:
-            resp = spacy.prefer_gpu()
-            
-            if use_gpu and not resp:
-                print("Using GPU failed, falling back on CPU...")
+                 output_df=True, n_process=1, batch_size=None, pipeline_mode='full', dtype_backend=None, progress=True,
+                 lemma_memo=None, lemmatize_on_miss=False, deduplicate=False, text_cache=None,
+                 token_budget=None, max_text_tokens=512):
+        if pipeline_mode not in ('full', 'lean'):
+            raise ValueError("pipeline_mode must be either 'full' or 'lean'.")
+
+        self.pipeline_path = pipeline_path
+
+        self.use_gpu = use_gpu
+
+        self.pipeline_mode = pipeline_mode
+
+        self.on_gpu = False
         
         self.output_df = output_df
-        
-        self.ner_pipeline = spacy.load(pipeline_path)
+
+        self.n_process = n_process
+
+        self.batch_size = batch_size
+
+        self.dtype_backend = dtype_backend
+
+        self.progress = progress
+
+        if lemma_memo is True:
+            lemma_memo = cache.lemma_memo()
+        self.lemma_memo = lemma_memo if lemma_memo is not False else None
+
+        if lemmatize_on_miss and self.lemma_memo is None:
+            raise ValueError("lemmatize_on_miss requires a lemma_memo.")
+        self.lemmatize_on_miss = lemmatize_on_miss
+
+        self.deduplicate = deduplicate
+
+        if isinstance(text_cache, str):
+            text_cache = cache.persistent_cache(text_cache)
+        self.text_cache = text_cache
+
+        if token_budget is not None and token_budget < max_text_tokens:
+            raise ValueError("token_budget must be at least max_text_tokens, so that every text fits in a batch.")
+        self.token_budget = token_budget
+
+        self.max_text_tokens = max_text_tokens
+
+        self._pipeline = None
+        self._load_lock = threading.Lock()
+        self._warm_up_thread = None
+
+    @property
+    def ner_pipeline(self):
+        """The Spacy pipeline, loaded on first access."""
+        if self._pipeline is None:
+            self.load_pipeline()
+        return self._pipeline
+
+    def load_pipeline(self):
+        """Loads the Spacy pipeline, unless it has been loaded already. Safe to call from several threads."""
+        with self._load_lock:
+            if self._pipeline is not None:
+                return self._pipeline
+
+            import spacy
+
+            if self.use_gpu:
+                resp = spacy.prefer_gpu()
+                
+                if not resp:
+                    print("Using GPU failed, falling back on CPU...")
+                self.on_gpu = bool(resp)
+
+            self._pipeline = spacy.load(self.pipeline_path)
+
+            if self.pipeline_mode == 'lean':
+                for name in self.unused_components():
+                    self._pipeline.disable_pipe(name)
+            return self._pipeline
+
+    def warm_up(self):
+        """Starts loading the pipeline in a background thread, so that it's ready (or closer to it) when first needed."""
+        if self._pipeline is None and self._warm_up_thread is None:
+            self._warm_up_thread = threading.Thread(target=self.load_pipeline, daemon=True)
+            self._warm_up_thread.start()
+        return self._warm_up_thread
+
+    def unused_components(self):
+        """Works out which components of the pipeline are not needed for named entities and their lemmas.
+        Output: a list of the names of the components that can be disabled."""
+        nlp = self._pipeline
+
+        # shared embedding layers are needed by the components listening to them. Components that don't
+        # declare what they assign (like the attribute ruler) are kept as well, as it's not known if they are needed
+        needed = {name for name in nlp.pipe_names
+                  if nlp.get_pipe_meta(name).factory in EMBEDDING_FACTORIES or not nlp.get_pipe_meta(name).assigns}
+        needed_attrs = set(ENTITY_ATTRS)
+
+        # the rule-based lemmatizers (like the Voikko one) need part-of-speech tags, the lookup ones don't
+        for name in nlp.pipe_names:
+            if 'token.lemma' in nlp.get_pipe_meta(name).assigns:
+                needed_attrs.add('token.lemma')
+                if getattr(nlp.get_pipe(name), 'mode', None) != 'lookup':
+                    needed_attrs.update(POS_ATTRS)
+
+        # add the components assigning the needed attributes, and the ones they in turn require
+        changed = True
+        while changed:
+            changed = False
+            for name in nlp.pipe_names:
+                meta = nlp.get_pipe_meta(name)
+                if name not in needed and needed_attrs.intersection(meta.assigns):
+                    needed.add(name)
+                    needed_attrs.update(meta.requires)
+                    changed = True
+
+        return [name for name in nlp.pipe_names if name not in needed]
+
+    def component_timings(self, input_texts, batch_size=None):
+        """Runs the texts through the enabled components of the pipeline one component at a time.
+        Output: a dictionary of component names and the seconds spent in them. 'tokenizer' is included."""
+        timings = {}
+
+        t = time.perf_counter()
+        docs = [self.ner_pipeline.make_doc(text) for text in input_texts]
+        timings['tokenizer'] = time.perf_counter() - t
+
+        kwargs = {'batch_size': batch_size or self.batch_size or self.ner_pipeline.batch_size}
+        for name, component in self.ner_pipeline.pipeline:
+            t = time.perf_counter()
+            if hasattr(component, 'pipe'):
+                docs = list(component.pipe(docs, **kwargs))
+            else:
+                docs = [component(doc) for doc in docs]
+            timings[name] = time.perf_counter() - t
+
+        return timings
         
     def tag_sentences(self, input_texts, ids, explode_df=False, drop_non_locs=False, preprocess=False,
-                            filter_toponyms = True, entity_tags=['LOC', 'FAC', 'GPE']
+                            filter_toponyms = True, entity_tags=['LOC', 'FAC', 'GPE'], n_process=None, batch_size=None
         ):
         """Input:            
             texts | A string or a list of input strings: The input 
@@ -58,144 +262,477 @@ class toponym_tagger:
             *preprocess | Boolean: Whether to remove noise from the input texts, such as @-mentions and urls.
             *filter_toponyms | Boolean: Whether to filter out almost certain false positive toponyms.
                                         Currently removes toponyms with length less than 2. Default True.
+            *n_process | Int: Number of worker processes for the pipeline. Default None (use the value given at init).
+            *batch_size | Int: Number of texts per pipeline batch. Default None (use the value given at init).
         
         Output: Pandas DF containing columns:
                 1. input_text: the input sentence | String
-                2. doc: Spacy doc object of the sent analysis. See https://spacy.io/api/doc | Doc
-                3. toponyms_found: Whether locations were found in the input sent | Bool
-                4. locations: locations in the input text, if found | list of strings or None
-                5. topo_lemmas: lemmatized versions of the locations | list of strings or None
-                6. topo_spans: the index of the start and end characters of the identified 
+                2. toponyms: toponyms in the input text, if found | list of strings or None
+                3. topo_lemmas: lemmatized versions of the toponyms | list of strings or None
+                4. topo_labels: the named entity labels of the toponyms | list of strings or None
+                5. topo_spans: the index of the start and end characters of the identified 
                               locations in the input text string | tuple
+                6. toponyms_found: Whether locations were found in the input sent | Bool
                 7. input_order: the index of the inserted texts. i.e. the first text is 0, the second 1 etc.
                                 Makes it easier to reassemble the results if they're exploded | int'
                 *8. id: The identifying element tied to each input text, if provided | string, int, float 
         """
-        assert input_texts, "No input provided. Make sure to input a list of strings."
-        tagged_sentences = []
-        
-        self.explode_df = explode_df
+        results = self.tag_texts(input_texts, preprocess=preprocess, filter_toponyms=filter_toponyms,
+                                 entity_tags=entity_tags, n_process=n_process, batch_size=batch_size)
         
-        self.drop_non_locs = drop_non_locs
+        return self.to_dataframe(results, ids, explode_df=explode_df, drop_non_locs=drop_non_locs)
+
+    def tag_texts(self, input_texts, preprocess=False, filter_toponyms=True, entity_tags=['LOC', 'FAC', 'GPE'],
+                  n_process=None, batch_size=None, stats=None, on_batch=None):
+        """Runs the toponym recognition like 'tag_sentences', but returns the results as a tag_buffer of flat columns
+        instead of a DataFrame. See 'to_dataframe' for turning it into one.
+
+        If a geoparse_stats object is given as stats, the time spent in preprocessing, in the Spacy pipeline and in
+        extracting the features from the docs is recorded in it, as are the numbers of texts and toponyms.
+
+        on_batch is called with the lemmas of the toponyms found in each batch of texts as soon as the batch has been
+        tagged, e.g. to start geocoding them while the next batches are still being tagged. The time it blocks
+        is not counted in the stats."""
+        assert input_texts, "No input provided. Make sure to input a list of strings."
         
         self.filter_toponyms = filter_toponyms
         
         self.entity_tags = entity_tags
+
+        tagged_sentences = tag_buffer()
+        pipe_kwargs = self.pipe_kwargs(n_process, batch_size)
+        memo_before = self.lemma_memo.stats() if self.lemma_memo is not None else None
+
+        if self.deduplicate or self.text_cache is not None:
+            if preprocess:
+                with timed(stats, 'preprocess'):
+                    input_texts = self.preprocess_texts(input_texts)
+
+            # tag each distinct text only once (and not at all, if it's in the text cache)
+            features = dict.fromkeys(input_texts)
+            if self.text_cache is not None:
+                keys = {text: self.text_cache_key(text) for text in features}
+                cached = self.text_cache.get_many(list(keys.values()))
+                for text, key in keys.items():
+                    if key in cached:
+                        features[text] = tuple(tuple(toponym) for toponym in cached[key])
+                if on_batch is not None:
+                    on_batch([toponym[1] for found in features.values() if found for toponym in found])
+
+            missing = [text for text, found in features.items() if found is None]
+            if missing:
+                iter_features = self.iter_scheduled if self.token_budget else self.iter_features
+                for text, found in iter_features(missing, pipe_kwargs, stats=stats, on_batch=on_batch):
+                    features[text] = found
+            if self.text_cache is not None and missing:
+                self.text_cache.set_many({keys[text]: features[text] for text in missing})
+
+            # fan the results out to the duplicates
+            for text in input_texts:
+                tagged_sentences.append(text, features[text])
+
+            if stats is not None:
+                stats.count('unique_texts', len(features))
+                stats.count('tagged_texts', len(missing))
+        elif self.token_budget:
+            # the texts are sorted by their lengths, so they're all needed up front
+            if preprocess:
+                with timed(stats, 'preprocess'):
+                    input_texts = self.preprocess_texts(input_texts)
+            for text, found in self.iter_scheduled(input_texts, pipe_kwargs, stats=stats, on_batch=on_batch):
+                tagged_sentences.append(text, found)
+        else:
+            # the texts are preprocessed as the pipeline reads them, so with several processes,
+            # the cleaning runs at the same time as the recognition
+            texts = self.preprocess_stream(input_texts, stats) if preprocess else input_texts
+            for text, found in self.iter_features(texts, pipe_kwargs, n_texts=len(input_texts), stats=stats,
+                                                  on_batch=on_batch):
+                tagged_sentences.append(text, found)
+
+        if stats is not None:
+            stats.count('texts', len(tagged_sentences))
+            stats.count('entities', len(tagged_sentences.toponyms))
+            if memo_before is not None:
+                memo_after = self.lemma_memo.stats()
+                stats.count('lemma_memo_hits', memo_after['hits'] - memo_before['hits'])
+                stats.count('lemma_memo_misses', memo_after['misses'] - memo_before['misses'])
         
-        # apply preprocessing step, if requested
-        if preprocess:
-            input_texts = [self.preprocess_sent(sent) for sent in tqdm(input_texts, desc="Preprocessing input...")]
-        
-        # run spacy pipeline 
-        tag_results = list(tqdm(self.ner_pipeline.pipe(input_texts), total=len(input_texts), desc="Running toponym recognition..."))
-        
-        # gather the wanted features from spacy doc objects into a dictionary of lists
-        tagged_sentences = [self.get_features(sent) for sent in tag_results]
-        
-        return self.to_dataframe(tagged_sentences, ids)
-        """
-        if self.output_df:
-            return self.to_dataframe(tagged_sentences)
+        return tagged_sentences
+
+    def iter_features(self, texts, pipe_kwargs, n_texts=None, stats=None, on_batch=None, batches=None):
+        """Runs the texts through the pipeline and yields the text of each doc and its features (see get_features).
+        The docs themselves (and their transformer tensors) are not kept around, only the extracted features are.
+        If batches (lists of texts) are given instead of texts, each is processed as one batch of its own."""
+        from tqdm import tqdm
+
+        # with lemmatize_on_miss, the lemmatizer is left out of the pipeline and only run on the docs
+        # with toponyms that aren't memoized yet
+        lemmatizers = self.lemmatizer_names() if self.lemmatize_on_miss else []
+        batch_every = pipe_kwargs.get('batch_size') or self.ner_pipeline.batch_size
+        batch_lemmas = []
+        n_docs = 0
+
+        # the pipe is lazy, so the time spent waiting for the next doc is the time spent in the pipeline
+        pipe_time = feature_time = 0.0
+        preprocess_before = stats.timers.get('preprocess', 0.0) if stats is not None else 0.0
+
+        with self.ner_pipeline.select_pipes(disable=lemmatizers) if lemmatizers else nullcontext():
+            # run spacy pipeline, possibly in several processes. The docs are returned in input order regardless
+            if batches is not None:
+                docs = chain.from_iterable(self.ner_pipeline.pipe(batch, **{**pipe_kwargs, 'batch_size': len(batch)})
+                                           for batch in batches)
+            else:
+                docs = self.ner_pipeline.pipe(texts, **pipe_kwargs)
+            t = time.perf_counter()
+            for doc in tqdm(docs, total=n_texts if n_texts is not None else len(texts),
+                            desc="Running toponym recognition...", disable=not self.progress):
+                t_doc = time.perf_counter()
+                if lemmatizers and self.has_memo_misses(doc):
+                    for name in lemmatizers:
+                        doc = self.ner_pipeline.get_pipe(name)(doc)
+                features = self.get_features(doc)
+                t_features = time.perf_counter()
+                pipe_time += t_doc - t
+                feature_time += t_features - t_doc
+
+                yield doc.text, features
+                n_docs += 1
+
+                if on_batch is not None:
+                    batch_lemmas.extend(toponym[1] for toponym in features)
+                    if n_docs % batch_every == 0:
+                        on_batch(batch_lemmas)
+                        batch_lemmas = []
+                t = time.perf_counter()
+
+        if on_batch is not None and n_docs % batch_every:
+            on_batch(batch_lemmas)
+
+        if stats is not None:
+            # the pipeline's reading of the texts includes their preprocessing
+            pipe_time -= stats.timers.get('preprocess', 0.0) - preprocess_before
+            stats.add_time('spacy_pipe', pipe_time)
+            stats.add_time('feature_extraction', feature_time)
+
+    def iter_scheduled(self, texts, pipe_kwargs, stats=None, on_batch=None):
+        """Like iter_features, but splits the over-long texts into windows (see split_text), runs the windows through
+        the pipeline from the shortest to the longest in batches of at most token_budget tokens, and yields each text
+        and its features in the input order once all of its windows are done."""
+        # the windows of all texts: (index of the text, character offset of the window, window, estimated tokens)
+        windows = [(i, offset, window, n_tokens) for i, text in enumerate(texts)
+                   for offset, window, n_tokens in self.split_text(text)]
+        order = sorted(range(len(windows)), key=lambda w: windows[w][3])
+        sorted_windows = [windows[w][2] for w in order]
+
+        if pipe_kwargs['n_process'] == 1:
+            batches = self.token_batches([windows[w][3] for w in order], self.token_budget)
+            docs = self.iter_features(None, pipe_kwargs, n_texts=len(windows), stats=stats, on_batch=on_batch,
+                                      batches=[sorted_windows[start:end] for start, end in batches])
         else:
-            return tagged_sentences
-        """
+            # the worker processes get the batches in a stream, so only the order can be fixed
+            docs = self.iter_features(sorted_windows, pipe_kwargs, stats=stats, on_batch=on_batch)
+
+        features = [None] * len(windows)
+        # docs come first in the zip, so that it runs to its end, where the last batch is passed on and timed
+        for (_, found), w in zip(docs, order):
+            features[w] = found
+            if stats is not None:
+                stats.count('windows')
+
+        # gather the windows of each text back together, shifting the spans by the offsets of the windows
+        w = 0
+        for i, text in enumerate(texts):
+            found = []
+            while w < len(windows) and windows[w][0] == i:
+                offset = windows[w][1]
+                found.extend(features[w] if not offset else
+                             [(toponym, lemma, label, start + offset, end + offset)
+                              for toponym, lemma, label, start, end in features[w]])
+                w += 1
+            yield text, tuple(found)
+
+    def split_text(self, text):
+        """Input: a text.
+        Output: a list of (character offset, window, estimated tokens) of the text. Texts of at most max_text_tokens
+        words are a single window. Longer texts are split after the last sentence that fits in a window, or between
+        words if a sentence alone is longer than that."""
+        words = [(match.start(), match.end()) for match in WORD_PATTERN.finditer(text)]
+        if len(words) <= self.max_text_tokens:
+            return [(0, text, max(len(words), 1))]
+
+        windows = []
+        first = 0
+        while first < len(words):
+            last = min(first + self.max_text_tokens, len(words))
+            if last < len(words):
+                # cut after the last sentence end in the window, if there is one
+                for w in range(last - 1, first, -1):
+                    if SENTENCE_END_PATTERN.search(text, words[w][0], words[w][1]):
+                        last = w + 1
+                        break
+            start = words[first][0]
+            windows.append((start, text[start:words[last - 1][1]], last - first))
+            first = last
+        return windows
+
+    @staticmethod
+    def token_batches(lengths, token_budget):
+        """Input: the token counts of the texts in ascending order and the maximum number of tokens in a batch.
+        Output: a list of (start, end) slices, each a batch whose texts padded to the longest one fit in the budget."""
+        batches = []
+        start = 0
+        for end, length in enumerate(lengths):
+            # the texts are sorted, so each text is the longest of its batch so far
+            if end > start and (end - start + 1) * length > token_budget:
+                batches.append((start, end))
+                start = end
+        if start < len(lengths):
+            batches.append((start, len(lengths)))
+        return batches
+
+    def text_cache_key(self, text):
+        """The key of a text in the text cache: a hash of the text, the pipeline and the tagging settings."""
+        meta = self.ner_pipeline.meta
+        key = cache.persistent_cache.make_key(text, f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}",
+                                              self.ner_pipeline.pipe_names, self.filter_toponyms, self.entity_tags,
+                                              self.token_budget, self.max_text_tokens)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
             
+    def pipe_kwargs(self, n_process=None, batch_size=None):
+        """Forms the keyword arguments for the pipe call of the Spacy pipeline."""
+        # whether the pipeline runs on the GPU is only known once it's loaded
+        self.load_pipeline()
+        n_process = n_process if n_process is not None else self.n_process
+        batch_size = batch_size if batch_size is not None else self.batch_size
+
+        # multiprocessing is not supported on the GPU
+        if self.on_gpu and n_process != 1:
+            print("Multiple processes are not supported on the GPU, running in a single process...")
+            n_process = 1
+
+        kwargs = {'n_process': n_process}
+        if batch_size:
+            kwargs['batch_size'] = batch_size
+        return kwargs
+
     def get_features(self, doc):
-        """Input: a sentence to tag (string)
-        Output: a dictionary with the same variables as listed in 'tag_sentences'"""
-        #doc = self.ner_pipeline(sent)
+        """Input: a Spacy doc of a tagged sentence
+        Output: a tuple of the toponyms found, each a tuple of (toponym, lemma, label, start character, end character)"""
         
-        # if the tagger created an output, i.e. at least one of the words in the input
-        # was tagged, create an output of that. Otherwise, return a mostly empty dict
-        #docs = []
         toponyms = []
-        topo_labels = []
-        topo_lemmas = []
-        topo_spans = []
-        toponyms_found = False
-
-        # gather the NER labels found to a list 
-        labels = [ent.label_ for ent in doc.ents]
-
+        memo = self.lemma_memo
 
         # looping through the entities, collecting required information
-        # namely, the raw toponym text, its lemmatized form and the span as tuple
+        # namely, the raw toponym text, its lemmatized form, its label and the span
         for ent in doc.ents:
             if ent.label_ in self.entity_tags:
-                # apply filtering if requested
-                if self.filter_toponyms:
-                    # length filtering 
-                    if len(ent.text)>1:
-                        toponyms.append(ent.text)
-                        topo_labels.append(ent.label_)
-                        
-                        # remove hashtags, which mark word boundaries in compound words
-                        lemma = ent.lemma_.replace("#","")
-                        # in addition, remove punctuation characters, if they were captured by the tagger
-                        # included are various quotation marks
-                        lemma = re.sub(r'[.?!;:\'"“”‘’]', '', lemma)
-                        
-                        # add lemmatized versions of the toponyms to list 
-                        topo_lemmas.append(lemma)
-                        # spans; character start and end locations 
-                        topo_spans.append((ent.start_char, ent.end_char))
-                        toponyms_found = True
-                else:
-                    toponyms.append(ent.text)
-                    topo_labels.append(ent.label_)
-                    topo_lemmas.append(ent.lemma_.replace("#",""))
-                    topo_spans.append((ent.start_char, ent.end_char))
-                    toponyms_found = True
-       #docs.append(doc)
-
-        if toponyms_found:        
-            doc_results = {'input_text': doc.text, 'toponyms': toponyms, 'topo_lemmas': topo_lemmas,
-                            'topo_labels':topo_labels, 'topo_spans': topo_spans,'toponyms_found': toponyms_found}
-        else:
-            doc_results = {'input_text': doc.text, 'locations': None, 'topo_lemmas': None,
-                    'topo_labels':None,'topo_spans': None, 'toponyms_found': toponyms_found}
+                # apply filtering if requested: length filtering
+                if self.filter_toponyms and len(ent.text) < 2:
+                    continue
+
+                lemma = None
+                if memo is not None:
+                    key = (ent.text, ent.label_, self.filter_toponyms)
+                    lemma = memo.get(key)
+
+                if lemma is None:
+                    # remove hashtags, and with filtering, punctuation. See LEMMA_TABLE
+                    lemma = ent.lemma_.translate(LEMMA_TABLE if self.filter_toponyms else HASH_TABLE)
+                    if memo is not None:
+                        memo.set(key, lemma)
 
-        return doc_results
+                toponyms.append((ent.text, lemma, ent.label_, ent.start_char, ent.end_char))
+
+        return tuple(toponyms)
+
+    def has_memo_misses(self, doc):
+        """Whether the doc has toponyms whose lemmas are not in the lemma memo. The toponyms that get_features
+        filters out are never memoized, so they don't count."""
+        return any((ent.text, ent.label_, self.filter_toponyms) not in self.lemma_memo
+                   for ent in doc.ents if ent.label_ in self.entity_tags
+                   and not (self.filter_toponyms and len(ent.text) < 2))
+
+    def lemmatizer_names(self):
+        """The names of the enabled pipeline components that assign lemmas."""
+        nlp = self.ner_pipeline
+        return [name for name in nlp.pipe_names if 'token.lemma' in nlp.get_pipe_meta(name).assigns]
     
-    def preprocess_sent(self, sent):
-        """Optionally cleans up noise (especially prominent in social media posts): removes emojis (TODO), mentions (@xyz), hashtags (#, but not the content) and URLs.
+    def preprocess_sent(self, sent, remove_emojis=True):
+        """Optionally cleans up noise (especially prominent in social media posts): removes emojis, mentions (@xyz), hashtags (#, but not the content) and URLs.
         Based on work by Hiippala et al. 2020: Mapping the languages of Twitter in Finland: richness and diversity in space and time. See: https://zenodo.org/record/4279402
+        All of the noise is removed in a single pass with a precompiled pattern, see NOISE.
         """
-        # Remove all mentions (@) in the input
-        sent = re.sub(r'@\S+ *', '', sent)
-        
-        # remove hashes from hashtags
-        sent = sent.replace('#', '')
-        
-        # remove old school heart emojis <3
-        sent = sent.replace('<3', '')
-        
-        # remove ampersand (&), which may be followed by 'amp'
-        sent = re.sub(r'&amp|&', '', sent)
-        
-        # remove URL's: i.e. remove everything that follows http(s) until a whitespace
-        sent = re.sub(r'http[s]?://\S+', "", sent)
-        
-        return sent
+        return (NOISE_AND_EMOJI_PATTERN if remove_emojis else NOISE_PATTERN).sub('', sent)
+
+    def preprocess_texts(self, input_texts, remove_emojis=True):
+        """Preprocesses a list of texts with 'preprocess_sent'. Output: a list of the cleaned texts."""
+        sub = (NOISE_AND_EMOJI_PATTERN if remove_emojis else NOISE_PATTERN).sub
+        return [sub('', sent) for sent in input_texts]
+
+    def preprocess_stream(self, input_texts, stats=None):
+        """Yields the preprocessed texts one by one, e.g. for feeding them to the pipeline as it reads them.
+        The time spent is recorded in the stats as 'preprocess' once all the texts have been read."""
+        sub = NOISE_AND_EMOJI_PATTERN.sub
+        elapsed = 0.0
+        for sent in input_texts:
+            t = time.perf_counter()
+            sent = sub('', sent)
+            elapsed += time.perf_counter() - t
+            yield sent
+
+        if stats is not None:
+            stats.add_time('preprocess', elapsed)
         
         
-    def to_dataframe(self, results, ids):
-        df = pd.DataFrame(results)
+    def to_dataframe(self, results, ids=None, explode_df=False, drop_non_locs=False, extra_columns=None, order_offset=0,
+                     stats=None):
+        """Builds the output DataFrame from a tag_buffer in one go, without exploding or applying row by row.
+
+        Input:
+            results | tag_buffer: the tagging results.
+            *ids | list: Identifying element of each input text. Default None.
+            *explode_df | Boolean: Whether each toponym gets its own row. Default False.
+            *drop_non_locs | Boolean: Whether texts without toponyms are left out. Default False.
+            *extra_columns | Dictionary of lists: Additional values for each toponym, in the same order as the
+                             flat toponym columns of the buffer, e.g. the geocoder results. Default None.
+            *order_offset | Int: Added to input_order, when the texts are a part of a larger input. Default 0.
+            *stats | geoparse_stats: Records the time spent in laying out the extra columns ('concat') and
+                     the rest of the DataFrame ('dataframe'). Default None.
+
+        Output: a Pandas DataFrame with the columns listed in 'tag_sentences', followed by the extra columns."""
+        import numpy as np, pandas as pd
+
+        start = time.perf_counter()
+        counts = np.asarray(results.counts, dtype=np.int64)
+        offsets = results.offsets()
+        found = counts > 0
+
+        columns = {'toponyms': results.toponyms,
+                   'topo_lemmas': results.topo_lemmas,
+                   'topo_labels': results.topo_labels,
+                   'topo_spans': list(zip(results.span_starts, results.span_ends))}
+        extra_columns = extra_columns or {}
+
+        if explode_df:
+            # one row per toponym, and one row per text without any (unless those are dropped)
+            rows = counts if drop_non_locs else np.maximum(counts, 1)
+            text_index = np.repeat(np.arange(len(counts)), rows)
+            row_found = np.repeat(found, rows)
+            # the position of each row's toponym in the flat columns, -1 for no toponym
+            within = np.arange(len(text_index)) - np.repeat(np.cumsum(rows) - rows, rows)
+            indexer = np.where(row_found, offsets[:-1][text_index] + within, -1)
+
+            def layout(values):
+                return _take(_object_array(values), indexer)
+        else:
+            text_index = np.flatnonzero(found) if drop_non_locs else np.arange(len(counts))
+            row_found = found[text_index]
+            bounds = list(zip(offsets[:-1][text_index].tolist(), offsets[1:][text_index].tolist()))
+
+            def layout(values):
+                return [list(values[a:b]) if a != b else None for a, b in bounds]
+
+        df = pd.DataFrame({'input_text': _object_array(results.input_texts)[text_index]})
+        for name, values in columns.items():
+            df[name] = layout(values)
+        df['toponyms_found'] = row_found
         
         if ids:
-            df['id'] = ids
+            df['id'] = _object_array(ids)[text_index]
             
-        df['input_order'] = df.index
-        
-        # split the possible list contents into multiple rows
-        if self.explode_df:
-            df = df.apply(lambda x: x.explode() if x.name in ['toponyms', 'topo_labels', 'topo_lemmas', 'topo_spans'] else x)
-        if self.drop_non_locs:
-            return self.drop_non_locations(df)
-        else:
-            return df
+        df['input_order'] = text_index + order_offset
+
+        t = time.perf_counter()
+        for name, values in extra_columns.items():
+            df[name] = layout(values)
+        concat_time = time.perf_counter() - t
+
+        if self.dtype_backend == 'pyarrow':
+            df = to_arrow_strings(df, nested=not explode_df)
+
+        if stats is not None:
+            stats.add_time('concat', concat_time)
+            stats.add_time('dataframe', time.perf_counter() - start - concat_time)
+        return df
     
     def drop_non_locations(self, df):
         """Remove input strings / rows where the tagger did not find any toponyms."""
         df = df[df['toponyms_found']]
         return df
+
+
+class tag_buffer:
+    """
+    Compact, flat storage for the tagging results of a batch. The toponyms of all the texts are kept in
+    the same lists (and spans in integer arrays), and 'counts' tells how many of them belong to each text.
+    """
+    __slots__ = ('input_texts', 'toponyms', 'topo_lemmas', 'topo_labels', 'span_starts', 'span_ends', 'counts')
+
+    def __init__(self):
+        self.input_texts = []
+        self.toponyms = []
+        self.topo_lemmas = []
+        self.topo_labels = []
+        self.span_starts = array('q')
+        self.span_ends = array('q')
+        self.counts = array('q')
+
+    def append(self, text, features):
+        """Adds the results of one text. 'features' is the output of toponym_tagger.get_features."""
+        self.input_texts.append(text)
+        self.counts.append(len(features))
+        for toponym, lemma, label, start, end in features:
+            self.toponyms.append(toponym)
+            self.topo_lemmas.append(lemma)
+            self.topo_labels.append(label)
+            self.span_starts.append(start)
+            self.span_ends.append(end)
+
+    def __len__(self):
+        return len(self.input_texts)
+
+    def offsets(self):
+        """The start of each text's toponyms in the flat columns, followed by the total number of toponyms."""
+        import numpy as np
+        offsets = np.zeros(len(self.counts) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(self.counts, dtype=np.int64), out=offsets[1:])
+        return offsets
+
+
+def _object_array(values):
+    """A 1-dimensional object array, even if the values are lists or tuples of the same length."""
+    import numpy as np
+    try:
+        return np.fromiter(values, dtype=object, count=len(values))
+    except ValueError:
+        # older NumPy versions can't build object arrays with fromiter
+        arr = np.empty(len(values), dtype=object)
+        for i, value in enumerate(values):
+            arr[i] = value
+        return arr
+
+
+def _take(values, indexer):
+    """Takes the values at the indexer positions, and None where the indexer is -1."""
+    import numpy as np
+    if not len(values):
+        return np.full(len(indexer), None, dtype=object)
+    taken = values.take(np.maximum(indexer, 0))
+    taken[indexer < 0] = None
+    return taken
+
+
+def to_arrow_strings(df, nested=False):
+    """Converts the text columns of the output to Arrow-backed dtypes, if pyarrow is available."""
+    import pandas as pd
+    try:
+        import pyarrow as pa
+    except ImportError:
+        print("pyarrow is not installed, returning NumPy-backed columns...")
+        return df
+
+    for name in STRING_COLUMNS:
+        if name in df:
+            dtype = pa.list_(pa.string()) if nested and name != 'input_text' else pa.string()
+            df[name] = pd.array(df[name], dtype=pd.ArrowDtype(dtype))
+    return df
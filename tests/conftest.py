@@ -0,0 +1,49 @@
+import pytest
+
+import stubs
+
+
+PLACES = {'Helsinki': (24.94, 60.17, 'locality'),
+          'Tampere': (23.76, 61.50, 'locality'),
+          'Kamppi': (24.93, 60.17, 'neighbourhood'),
+          'Suomi': (26.0, 64.0, 'country'),
+          'Hollola': (25.51, 61.05, 'localadmin')}
+
+# names with several places, in the order of the geocoder's ranking
+AMBIGUOUS = {'Lahti': [(13.44, 59.31, 'Lahti, Sweden'), (25.66, 60.98, 'Lahti, Finland')]}
+
+
+LEMMAS = {'Helsingissä': 'Helsinki', 'Tampereelle': 'Tampere', 'Kampissa': 'Kamppi', 'Suomessa': 'Suomi',
+          'Lahdessa': 'Lahti', 'Hollolassa': 'Hollola'}
+
+ENTITIES = {**{name: 'GPE' for name in ('Helsinki', 'Helsingissä', 'Tampereelle', 'Suomessa', 'Lahdessa',
+                                        'Hollolassa')},
+            'Kampissa': 'LOC', 'Paris Hilton': 'PERSON'}
+
+
+def build_stub_pipeline():
+    return stubs.build_stub_pipeline(ENTITIES, LEMMAS)
+
+
+def search_features(text, size):
+    features = []
+    if text in PLACES:
+        lon, lat, layer = PLACES[text]
+        features.append(stubs.feature(lon, lat, f'whosonfirst:{layer}:{len(text)}', layer, f'{text}, Finland'))
+    for i, (lon, lat, label) in enumerate(AMBIGUOUS.get(text, [])[:size]):
+        features.append(stubs.feature(lon, lat, f'whosonfirst:locality:{i}', 'locality', label))
+    return features
+
+
+@pytest.fixture(scope='session')
+def pipeline_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp('pipeline') / 'stub_pipeline'
+    build_stub_pipeline().to_disk(path)
+    return str(path)
+
+
+@pytest.fixture
+def pelias():
+    server = stubs.pelias_stub(search_features).start()
+    yield server
+    server.stop()
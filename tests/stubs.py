@@ -0,0 +1,102 @@
+"""
+Stand-ins for the Spacy pipeline and the Pelias geocoder, shared by the tests and the benchmarks so that both run
+without model downloads or a geocoding service.
+"""
+
+import asyncio, threading
+
+import spacy
+from aiohttp import web
+from spacy.language import Language
+
+
+class stub_lemmatizer:
+    """Looks the lemmas of the tokens up from a dictionary of word forms. Tokens not in it are their own lemmas."""
+
+    def __init__(self, lemmas):
+        self.lemmas = lemmas
+
+    def __call__(self, doc):
+        for token in doc:
+            token.lemma_ = self.lemmas.get(token.text, token.text)
+        return doc
+
+
+@Language.factory('stub_lemmatizer', default_config={'lemmas': {}}, assigns=['token.lemma'])
+def make_stub_lemmatizer(nlp, name, lemmas):
+    return stub_lemmatizer(lemmas)
+
+
+def build_stub_pipeline(entities, lemmas):
+    """A tiny stand-in for the fi_geoparser pipeline: a rule-based NER and a lemma lookup.
+    'entities' maps the recognized phrases to their labels and 'lemmas' word forms to their lemmas."""
+    nlp = spacy.blank('fi')
+    ruler = nlp.add_pipe('entity_ruler')
+    ruler.add_patterns([{'label': label, 'pattern': phrase} for phrase, label in entities.items()])
+    nlp.add_pipe('stub_lemmatizer', config={'lemmas': lemmas})
+    return nlp
+
+
+def feature(lon, lat, gid, layer, label, bbox=None):
+    """A Pelias GeoJSON feature of a point."""
+    point = {'type': 'Feature',
+             'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+             'properties': {'gid': gid, 'layer': layer, 'label': label}}
+    if bbox is not None:
+        point['bbox'] = bbox
+    return point
+
+
+class pelias_stub:
+    """
+    A minimal Pelias /search endpoint running in a background thread. Records the requests and the distinct
+    connections made. 'failures' maps texts to lists of error statuses returned before answering normally.
+
+    Parameters:
+        search_features | Callable: takes the searched text and the number of results asked for ('size', 10 by
+                                    default like in Pelias) and returns a list of features for the response.
+
+        latency | Float: seconds to wait before each response, to mimic a network round trip. Default 0.
+    """
+
+    def __init__(self, search_features, latency=0):
+        self.search_features = search_features
+        self.latency = latency
+        self.requests = []
+        self.failures = {}
+        # the client addresses, i.e. the distinct connections made
+        self.connections = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def search(self, request):
+        text = request.query.get('text')
+        self.requests.append(dict(request.query))
+        self.connections.add(request.transport.get_extra_info('peername'))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failures.get(text):
+            return web.json_response({'geocoding': {'errors': ['busy']}, 'features': []},
+                                     status=self.failures[text].pop(0))
+        features = self.search_features(text, int(request.query.get('size', 10)))
+        return web.json_response({'type': 'FeatureCollection', 'features': features})
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_get('/v1/search', self.search)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        self.thread.start()
+        port = asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        self.url = f'http://127.0.0.1:{port}/v1/'
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
@@ -0,0 +1,72 @@
+import json
+
+import pandas as pd
+import pytest
+
+from fingerGeoparser import geoparser
+from fingerGeoparser.batch_job import batch_job
+
+
+TEXTS = ["Helsinki on kaunis tänään", "Paris Hilton mokasi.", "Olin Kampissa ja Helsingissä", "Menen Tampereelle"]
+
+
+@pytest.mark.parametrize('output_format', ['jsonl', 'parquet'])
+def test_resumed_job(pipeline_path, pelias, tmp_path, output_format):
+    if output_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    input_path = tmp_path / 'posts.csv'
+    pd.DataFrame({'text': TEXTS * 3, 'post_id': range(12)}).to_csv(input_path, index=False)
+    output_dir = tmp_path / 'results'
+
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    geoparse = gp.geoparse
+    calls = []
+
+    def failing_geoparse(texts, **kwargs):
+        calls.append(len(texts))
+        if len(calls) == 3:
+            raise RuntimeError("out of memory")
+        return geoparse(texts, **kwargs)
+
+    gp.geoparse = failing_geoparse
+    job = batch_job(gp, str(input_path), str(output_dir), id_column='post_id', chunk_size=5,
+                    output_format=output_format, verbose=False)
+    with pytest.raises(RuntimeError):
+        job.run()
+    assert sorted(json.loads((output_dir / '_manifest.json').read_text())['chunks']) == ['0', '1']
+
+    # the restarted job only geoparses the last chunk
+    manifest = job.run()
+    assert calls == [5, 5, 2, 2]
+    assert manifest['finished']
+
+    files = [output_dir / manifest['chunks'][str(i)]['file'] for i in range(3)]
+    if output_format == 'parquet':
+        results = pd.concat([pd.read_parquet(path) for path in files])
+    else:
+        results = pd.concat([pd.read_json(path, lines=True) for path in files])
+    assert results['input_order'].unique().tolist() == list(range(12))
+    assert results['id'].unique().tolist() == list(range(12))
+    assert results['topo_lemmas'].tolist()[-1] == 'Tampere'
+
+
+@pytest.mark.parametrize('explode_df', [True, False])
+def test_parquet_dataset(pipeline_path, pelias, tmp_path, explode_df):
+    pytest.importorskip('pyarrow')
+    import pyarrow.dataset as ds
+
+    input_path = tmp_path / 'posts.jsonl'
+    # the first chunk has no toponyms at all
+    pd.DataFrame({'text': ["Paris Hilton mokasi.", "Ei mitään."] + TEXTS}).to_json(input_path, orient='records',
+                                                                                     lines=True)
+    output_dir = tmp_path / 'results'
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    batch_job(gp, str(input_path), str(output_dir), chunk_size=2, verbose=False, explode_df=explode_df).run()
+
+    # the parts share a schema, and the manifest isn't read as a part of the dataset
+    schemas = [ds.dataset(str(path)).schema.remove_metadata() for path in sorted(output_dir.glob('part-*.parquet'))]
+    assert len(schemas) == 3 and all(schema.equals(schemas[0]) for schema in schemas)
+    results = pd.read_parquet(output_dir)
+    assert ds.dataset(str(output_dir)).to_table().num_rows == len(results)
+    texts = results.drop_duplicates('input_order').sort_values('input_order')['input_text'].tolist()
+    assert texts == ["Paris Hilton mokasi.", "Ei mitään."] + TEXTS
@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+from fingerGeoparser import geoparser
+from fingerGeoparser.gazetteer_coder import gazetteer_coder
+
+
+ROWS = [
+    (658225, 'Helsinki', 'Helsinki', 'Helsingfors,Helsingissä', 60.16952, 24.93545, 'P', 'PPLC', 'FI', 558457),
+    (4997500, 'Helsinki', 'Helsinki', '', 40.5, -89.5, 'P', 'PPL', 'US', 0),
+    (634963, 'Tampere', 'Tampere', 'Tammerfors', 61.49911, 23.78712, 'P', 'PPLA', 'FI', 206368),
+    (660013, 'Finland', 'Finland', 'Suomi,Suomen tasavalta', 64.0, 26.0, 'A', 'PCLI', 'FI', 5518050),
+    (658226, 'Kamppi', 'Kamppi', '', 60.1683, 24.9316, 'P', 'PPLX', 'FI', 0),
+]
+
+
+def write_geonames(path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in ROWS:
+            fields = [str(value) for value in row[:9]] + ['', '', '', '', '', str(row[9]), '', '', 'Europe/Helsinki', '2024-01-01']
+            f.write('\t'.join(fields) + '\n')
+    return str(path)
+
+
+def test_lookup(tmp_path):
+    coder = gazetteer_coder(write_geonames(tmp_path / 'geonames.txt'))
+    res = asyncio.run(coder.geocode_toponyms(['helsinki', 'Suomi', 'Mordor', 'Kamppi', None]))
+
+    assert res['coordinates'][0] == [24.93545, 60.16952]
+    assert res['gid'][:2] == ['geonames:locality:658225', 'geonames:country:660013']
+    assert res['layer'][3] == 'neighbourhood'
+    assert res['label'][2] is None and res['label'][4] is None
+
+    # the smaller Helsinki is found when the search is limited to the US
+    res = asyncio.run(coder.geocode_toponyms(['Helsinki'], params={'boundary.country': 'US'}))
+    assert res['gid'] == ['geonames:locality:4997500']
+
+    # Pelias-style alpha-3 codes work without countryInfo.txt, and unknown ones aren't silently filtered out
+    res = asyncio.run(coder.geocode_toponyms(['Helsinki', 'Tampere'], params={'boundary.country': 'USA,SWE'}))
+    assert res['gid'] == ['geonames:locality:4997500', None]
+    with pytest.raises(ValueError):
+        asyncio.run(coder.geocode_toponyms(['Helsinki'], params={'boundary.country': 'XYZ'}))
+
+
+def test_saved_index(tmp_path):
+    coder = gazetteer_coder(write_geonames(tmp_path / 'geonames.txt'))
+    coder.save(str(tmp_path / 'index'))
+
+    loaded = gazetteer_coder(str(tmp_path / 'index'))
+    assert len(loaded) == len(ROWS)
+    assert asyncio.run(loaded.geocode_toponyms(['Tammerfors'], columns=['label']))['label'] == ['Tampere, FI']
+
+
+def test_geoparse_offline(pipeline_path, tmp_path):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder=gazetteer_coder(write_geonames(tmp_path / 'geonames.txt')),
+                             verbose=False)
+    res = gp.geoparse(["Olin Kampissa ja Helsingissä"])
+
+    assert res['gid'].tolist() == ['geonames:neighbourhood:658226', 'geonames:locality:658225']
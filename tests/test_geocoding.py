@@ -0,0 +1,68 @@
+import asyncio
+
+from fingerGeoparser.toponym_coder import toponym_coder
+
+
+def test_unique_toponyms_requested_once(pelias):
+    coder = toponym_coder(pelias.url, health_check=False)
+    pelias.requests.clear()
+
+    res = asyncio.run(coder.geocode_toponyms(['Helsinki', None, 'Tampere', 'Helsinki', 'Mordor', 'Helsinki']))
+
+    assert sorted(r['text'] for r in pelias.requests) == ['Helsinki', 'Mordor', 'Tampere']
+    assert res['coordinates'] == [[24.94, 60.17], None, [23.76, 61.50], [24.94, 60.17], None, [24.94, 60.17]]
+    assert res['layer'][2] == 'locality'
+
+
+def test_persistent_cache(pelias, tmp_path):
+    path = str(tmp_path / 'geocode.sqlite')
+    coder = toponym_coder(pelias.url, cache_path=path, health_check=False)
+    asyncio.run(coder.geocode_toponyms(['Helsinki', 'Mordor']))
+
+    # a new coder with the same cache file does not need to request anything
+    coder = toponym_coder(pelias.url, cache_path=path, health_check=False)
+    pelias.requests.clear()
+    res = asyncio.run(coder.geocode_toponyms(['Mordor', 'Helsinki']))
+
+    assert pelias.requests == []
+    assert res['label'] == [None, 'Helsinki, Finland']
+    assert coder.cache.stats()['hits'] == 2
+
+
+def test_retries_and_failures(pelias, tmp_path):
+    coder = toponym_coder(pelias.url, cache_path=str(tmp_path / 'geocode.sqlite'), max_retries=2,
+                          health_check=False)
+    coder.engine.backoff_base = 0.001
+    pelias.failures = {'Tampere': [429, 502], 'Mordor': [503] * 5, 'Kamppi': [400]}
+
+    res = asyncio.run(coder.geocode_toponyms(['Tampere', 'Mordor', 'Kamppi', 'Helsinki']))
+
+    assert res['label'] == ['Tampere, Finland', None, None, 'Helsinki, Finland']
+    stats = coder.engine.stats()
+    # Tampere succeeds on the third try, Mordor fails three times, Kamppi isn't retried
+    assert stats['sent'] == 3 + 3 + 1 + 1
+    assert stats['retried'] == 2 + 2
+    assert stats['failed'] == 2
+    assert stats['in_flight'] == 0
+    # only the successful lookups are cached
+    assert len(coder.cache) == 2
+
+
+def test_query_parameters_and_keep_alive(pelias):
+    coder = toponym_coder(pelias.url, max_concurrency=2, layers=['locality', 'neighbourhood'], health_check=False)
+
+    async def geocode():
+        try:
+            return await coder.geocode_toponyms([f'Paikka{i}' for i in range(20)] + ['Kamppi'],
+                                                params={'boundary.country': 'FIN'})
+        finally:
+            await coder.aclose()
+
+    res = asyncio.run(geocode())
+
+    assert len(pelias.requests) == 21
+    assert all(r['size'] == '1' and r['layers'] == 'locality,neighbourhood' and r['boundary.country'] == 'FIN'
+               for r in pelias.requests)
+    # the requests reuse the same kept-alive connections
+    assert len(pelias.connections) <= 2
+    assert res['layer'][-1] == 'neighbourhood'
@@ -0,0 +1,148 @@
+import asyncio, gc
+
+import pytest
+
+from fingerGeoparser import geoparser
+
+
+TEXTS = ["Helsinki on kaunis tänään", "Paris Hilton mokasi.", "Olin Kampissa ja Helsingissä", "Menen Tampereelle"]
+
+
+def test_geoparse(pipeline_path, pelias):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    res = gp.geoparse(TEXTS, ids=['a', 'b', 'c', 'd'])
+
+    assert res['toponyms'].tolist() == ['Helsinki', None, 'Kampissa', 'Helsingissä', 'Tampereelle']
+    assert res['topo_lemmas'].tolist() == ['Helsinki', None, 'Kamppi', 'Helsinki', 'Tampere']
+    assert res['topo_spans'].tolist()[2] == (5, 13)
+    assert res['input_order'].tolist() == [0, 1, 2, 2, 3]
+    assert res['id'].tolist() == ['a', 'b', 'c', 'c', 'd']
+    assert res['coordinates'].tolist()[:2] == [[24.94, 60.17], None]
+
+
+def test_geoparse_stream(pipeline_path, pelias):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    chunks = list(gp.geoparse_stream(iter(TEXTS * 3), chunk_size=5))
+
+    assert [len(chunk['input_order'].unique()) for chunk in chunks] == [5, 5, 2]
+    assert chunks[-1]['input_order'].tolist()[-1] == 11
+    assert chunks[1]['layer'].tolist()[1] == 'neighbourhood'
+
+    # ids must match the texts both ways, like in geoparse
+    for ids in (range(11), range(13)):
+        with pytest.raises(ValueError):
+            list(gp.geoparse_stream(iter(TEXTS * 3), ids=iter(ids), chunk_size=5))
+    with pytest.raises(ValueError):
+        gp.geoparse(TEXTS, ids=[])
+
+
+def test_geoparse_multiprocess(pipeline_path, pelias):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    single = gp.geoparse(TEXTS * 5)
+    multi = gp.geoparse(TEXTS * 5, n_process=2, batch_size=3)
+
+    assert multi['input_order'].tolist() == single['input_order'].tolist()
+    assert multi['toponyms'].tolist() == single['toponyms'].tolist()
+
+
+def test_geoparse_nested(pipeline_path, pelias):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    res = gp.geoparse(TEXTS, explode_df=False, drop_non_locations=True)
+
+    assert res['input_order'].tolist() == [0, 2, 3]
+    assert res['topo_lemmas'].tolist() == [['Helsinki'], ['Kamppi', 'Helsinki'], ['Tampere']]
+    assert res['layer'].tolist()[1] == ['neighbourhood', 'locality']
+
+
+def test_stats_and_hooks(pipeline_path, pelias):
+    events = []
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False,
+                             hooks=[lambda event, name, value: events.append((event, name))])
+    gp.geoparse(TEXTS, profile='cprofile')
+    stats = gp.last_stats
+
+    assert {'spacy_pipe', 'feature_extraction', 'geocoding', 'dataframe', 'concat'} <= set(stats.timers)
+    assert stats.counters['texts'] == 4
+    assert stats.counters['entities'] == 4
+    assert stats.counters['unique_lemmas'] == 3
+    assert stats.summary('geocoder_latency')['count'] == stats.counters['http_requests']
+    assert ('stage', 'geocoding') in events and ('observe', 'geocoder_latency') in events
+    assert stats.profile.total_calls > 0
+
+
+def test_ageoparse(pipeline_path, pelias):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+
+    async def serve():
+        async with gp:
+            results = await asyncio.gather(*(gp.ageoparse(TEXTS) for _ in range(3)))
+            session = await gp.coder.open_session()
+            # the synchronous API works inside a running loop too
+            results.append(gp.geoparse(TEXTS))
+            assert await gp.coder.open_session() is session
+        assert session.closed
+        return results
+
+    results = asyncio.run(serve())
+
+    for res in results:
+        assert res['topo_lemmas'].tolist() == ['Helsinki', None, 'Kamppi', 'Helsinki', 'Tampere']
+        assert res['layer'].tolist()[2] == 'neighbourhood'
+
+
+def test_geoparse_pipelined(pipeline_path, pelias):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    sequential = gp.geoparse(TEXTS * 5)
+    pelias.requests.clear()
+    pipelined = gp.geoparse(TEXTS * 5, batch_size=2, pipelined=True)
+
+    assert sorted(r['text'] for r in pelias.requests) == ['Helsinki', 'Kamppi', 'Tampere']
+    for column in ('input_order', 'toponyms', 'coordinates', 'layer'):
+        assert pipelined[column].tolist() == sequential[column].tolist()
+
+    # the tagging runs in another thread, which is profiled as well
+    gp.geoparse(TEXTS, pipelined=True, profile='cprofile')
+    assert 'get_features' in {name for _, _, name in gp.last_stats.profile.stats}
+
+
+
+def test_geoparse_pipelined_failure(pipeline_path, pelias, caplog):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+
+    async def fail(*args, **kwargs):
+        raise ConnectionError("geocoder down")
+    gp.coder.geocode_toponyms = fail
+
+    with pytest.raises(ConnectionError):
+        gp.geoparse(TEXTS * 20, batch_size=1, pipelined=True)
+    gc.collect()
+    # the error of the stopped tagging is retrieved, not left to be logged
+    assert 'never retrieved' not in caplog.text
+
+
+def test_text_deduplication(pipeline_path, pelias, tmp_path):
+    cache_path = str(tmp_path / 'texts.sqlite')
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    expected = gp.geoparse(TEXTS * 3, ids=list(range(12)))
+
+    deduplicated = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False,
+                                       deduplicate_texts=True)
+    res = deduplicated.geoparse(TEXTS * 3, ids=list(range(12)))
+    assert deduplicated.last_stats.counters['tagged_texts'] == 4
+    for column in ('input_order', 'id', 'toponyms', 'topo_spans', 'coordinates'):
+        assert res[column].tolist() == expected[column].tolist()
+
+    # texts that only differ by their noise are duplicates after preprocessing
+    res = deduplicated.geoparse(['@ystävä ' + TEXTS[2], TEXTS[2], '#' + TEXTS[3]], preprocess_texts=True)
+    assert deduplicated.last_stats.counters['tagged_texts'] == 2
+    assert res['topo_lemmas'].tolist() == ['Kamppi', 'Helsinki', 'Kamppi', 'Helsinki', 'Tampere']
+
+    # the text cache persists between geoparsers
+    first = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False,
+                                text_cache=cache_path)
+    first.geoparse(TEXTS[:2])
+    second = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False,
+                                 text_cache=cache_path)
+    res = second.geoparse(TEXTS * 3, pipelined=True)
+    assert second.last_stats.counters['tagged_texts'] == 2
+    assert res['topo_lemmas'].tolist() == expected['topo_lemmas'].tolist()
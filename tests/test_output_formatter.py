@@ -0,0 +1,53 @@
+import io, json
+
+import pytest
+
+from fingerGeoparser import geoparser
+from fingerGeoparser.output_formatter import create_eupeg_json, write_results
+
+
+TEXTS = ["Helsinki on kaunis tänään", "Paris Hilton mokasi.", "Olin Kampissa ja Helsingissä", "Menen Tampereelle"]
+
+
+def test_writers(pipeline_path, pelias, tmp_path):
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    res = gp.geoparse(TEXTS, ids=['a', 'b', 'c', 'd'])
+
+    eupeg = json.loads(gp.geoparse(TEXTS, output='eupeg'))
+    assert eupeg['toponyms'][1] == {'start': 5, 'end': 13, 'phrase': 'Kampissa',
+                                    'place': {'footprint': res['coordinates'][2]}}
+    # the streamed document is the same, regardless of the batches
+    f = io.StringIO()
+    write_results(res, f, 'eupeg', batch_size=2)
+    assert json.loads(f.getvalue()) == json.loads(create_eupeg_json(res)) == eupeg
+
+    gp.geoparse_to_file(TEXTS * 2, str(tmp_path / 'out.geojson'), ids=list(range(8)), chunk_size=3)
+    with open(tmp_path / 'out.geojson', encoding='utf-8') as f:
+        features = json.load(f)['features']
+    assert len(features) == 8
+    assert features[0]['geometry'] == {'type': 'Point', 'coordinates': [24.94, 60.17]}
+    assert features[-1]['properties']['id'] == 7 and features[-1]['properties']['topo_spans'] == [6, 17]
+
+    f = io.StringIO()
+    write_results(gp.geoparse(TEXTS, explode_df=False), f, 'jsonl', batch_size=3)
+    rows = [json.loads(line) for line in f.getvalue().splitlines()]
+    assert [row['topo_lemmas'] for row in rows] == [['Helsinki'], None, ['Kamppi', 'Helsinki'], ['Tampere']]
+
+
+def test_writers_arrow(pipeline_path, pelias):
+    pytest.importorskip('pyarrow')
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False)
+    arrow_gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False,
+                                   dtype_backend='pyarrow')
+
+    # the missing values of Arrow-backed columns (pd.NA) are written like those of object columns
+    assert json.loads(arrow_gp.geoparse(TEXTS, output='eupeg')) == json.loads(gp.geoparse(TEXTS, output='eupeg'))
+
+    for explode_df in (True, False):
+        lines = []
+        for parser in (gp, arrow_gp):
+            f = io.StringIO()
+            write_results(parser.geoparse(TEXTS, explode_df=explode_df), f, 'jsonl')
+            lines.append([json.loads(line) for line in f.getvalue().splitlines()])
+        assert lines[1] == lines[0]
+        assert lines[1][1]['toponyms'] is None
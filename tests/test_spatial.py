@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fingerGeoparser import geoparser
+from fingerGeoparser.spatial import disambiguate, filter_results, spatial_index
+
+
+@pytest.mark.parametrize('block_size', [2000000, 1])
+def test_disambiguate(block_size):
+    espoo = [[[-88.0, 40.0], 'Espoo, Illinois'], [[24.65, 60.2], 'Espoo, Uusimaa, Finland']]
+    lahti = [[[13.44, 59.31], 'Lahti, Sweden'], [[25.66, 60.98], 'Lahti, Finland']]
+    uusimaa = [[[40.0, 10.0], 'Uusimaa']]
+    results = {'coordinates': [[-88.0, 40.0], [40.0, 10.0], [13.44, 59.31], [13.44, 59.31], [25.51, 61.05]],
+               'label': ['Espoo, Illinois', 'Uusimaa', 'Lahti, Sweden', 'Lahti, Sweden', 'Hollola'],
+               'candidates': [espoo, uusimaa, lahti, lahti, [[[25.51, 61.05], 'Hollola']]]}
+
+    changed = disambiguate([2, 1, 2], ['Espoo', 'Uusimaa', 'Lahti', 'Lahti', 'Hollola'], results,
+                           block_size=block_size)
+
+    # Espoo by co-occurrence with Uusimaa (which is far off), the second Lahti by its proximity to Hollola
+    assert changed == 2 and 'candidates' not in results
+    assert results['label'] == ['Espoo, Uusimaa, Finland', 'Uusimaa', 'Lahti, Sweden', 'Lahti, Finland', 'Hollola']
+    assert results['coordinates'][3] == [25.66, 60.98]
+
+
+def test_spatial_filter():
+    rng = np.random.default_rng(0)
+    points = rng.uniform([19, 59], [32, 70], size=(10000, 2)).tolist() + [None]
+    df = pd.DataFrame({'coordinates': points, 'input_order': range(len(points))})
+    lonlats = np.array(points[:-1])
+
+    inside = filter_results(df, bbox=(24, 60, 25.5, 61))
+    expected = np.flatnonzero((lonlats[:, 0] >= 24) & (lonlats[:, 0] <= 25.5) &
+                              (lonlats[:, 1] >= 60) & (lonlats[:, 1] <= 61))
+    assert inside['input_order'].tolist() == expected.tolist()
+
+    # a triangle, also combined with the bbox
+    triangle = [(20, 60), (30, 60), (20, 69)]
+    in_triangle = spatial_index(points).query_polygon(triangle)
+    x, y = lonlats[:, 0], lonlats[:, 1]
+    expected = np.flatnonzero((x > 20) & (y > 60) & ((x - 20) / 10 + (y - 60) / 9 < 1))
+    assert in_triangle.tolist() == expected.tolist()
+    assert set(filter_results(df, bbox=(24, 60, 25.5, 61), polygon=triangle)['input_order']) == \
+        set(inside['input_order']) & set(expected)
+
+
+def test_geoparse_candidates(pipeline_path, pelias):
+    texts = ["Lahdessa ja Hollolassa", "Lahdessa", "Menen Tampereelle"]
+    gp = geoparser.geoparser(pipeline_path=pipeline_path, geocoder_url=pelias.url, verbose=False, candidates=5)
+    res = gp.geoparse(texts)
+
+    assert res['label'].tolist() == ['Lahti, Finland', 'Hollola, Finland', 'Lahti, Sweden', 'Tampere, Finland']
+    assert 'candidates' not in res.columns
+    assert gp.last_stats.counters['disambiguated'] == 1
+    assert {r['size'] for r in pelias.requests if r['text'] != 'Kamppi'} == {'5'}
+
+    pipelined = gp.geoparse(texts, pipelined=True)
+    assert pipelined['coordinates'].tolist() == res['coordinates'].tolist()
@@ -0,0 +1,32 @@
+import json, subprocess, sys
+
+
+# seconds; importing and creating a geoparser takes about 0.1 s without the heavy libraries
+STARTUP_BUDGET = 1.0
+
+SCRIPT = """
+import json, sys, time
+t = time.perf_counter()
+from fingerGeoparser import geoparser
+gp = geoparser.geoparser(health_check=False)
+elapsed = time.perf_counter() - t
+print(json.dumps({'elapsed': elapsed, 'modules': [m for m in ('spacy', 'pandas', 'numpy', 'aiohttp', 'tqdm') if m in sys.modules]}))
+"""
+
+
+def test_startup_is_lazy():
+    out = subprocess.run([sys.executable, '-c', SCRIPT], capture_output=True, text=True, check=True).stdout
+    res = json.loads(out.strip().splitlines()[-1])
+
+    assert res['modules'] == []
+    assert res['elapsed'] < STARTUP_BUDGET
+
+
+def test_warm_up(pipeline_path):
+    from fingerGeoparser.toponym_tagger import toponym_tagger
+
+    tagger = toponym_tagger(pipeline_path, use_gpu=False)
+    assert tagger._pipeline is None
+
+    tagger.warm_up().join()
+    assert tagger._pipeline is not None
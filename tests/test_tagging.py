@@ -0,0 +1,90 @@
+from conftest import build_stub_pipeline
+
+from fingerGeoparser.cache import lemma_memo
+from fingerGeoparser.metrics import geoparse_stats
+from fingerGeoparser.toponym_tagger import toponym_tagger
+
+
+def test_lean_pipeline(tmp_path):
+    nlp = build_stub_pipeline()
+    nlp.add_pipe('sentencizer', first=True)
+    nlp.to_disk(tmp_path / 'pipeline')
+
+    tagger = toponym_tagger(str(tmp_path / 'pipeline'), use_gpu=False, pipeline_mode='lean')
+
+    assert tagger.ner_pipeline.disabled == ['sentencizer']
+    assert set(tagger.component_timings(["Menen Tampereelle"])) == {'tokenizer', 'entity_ruler', 'stub_lemmatizer'}
+
+    res = tagger.tag_sentences(["Menen Tampereelle"], None)
+    assert res['topo_lemmas'].tolist() == [['Tampere']]
+
+
+def test_preprocessing(pipeline_path):
+    tagger = toponym_tagger(pipeline_path, use_gpu=False)
+    texts = ["@kaveri Moi #Helsinki &amp; Tampere <3 https://t.co/abc jee",
+             "Kiitos @a@b kahvista 😀👍🏽 Suomessa 🇫🇮!"]
+
+    assert tagger.preprocess_texts(texts) == ["Moi Helsinki ; Tampere   jee", "Kiitos kahvista  Suomessa !"]
+    assert tagger.preprocess_sent(texts[1], remove_emojis=False) == "Kiitos kahvista 😀👍🏽 Suomessa 🇫🇮!"
+
+    res = tagger.tag_sentences(["@kaveri Olin Kampissa 😀"], None, preprocess=True)
+    # nb. the spans refer to the preprocessed text
+    assert res['input_text'].tolist() == ["Olin Kampissa "]
+    assert res['topo_spans'].tolist() == [[(5, 13)]]
+
+
+def test_lemma_memo(pipeline_path, tmp_path):
+    memo = lemma_memo(path=str(tmp_path / 'lemmas.json'))
+    tagger = toponym_tagger(pipeline_path, use_gpu=False, lemma_memo=memo, lemmatize_on_miss=True)
+    texts = ["Olin Kampissa", "Menen Tampereelle", "Kampissa taas", "Helsingissä ja Tampereelle"]
+
+    res = tagger.tag_sentences(texts, None)
+    assert res['topo_lemmas'].tolist() == [['Kamppi'], ['Tampere'], ['Kamppi'], ['Helsinki', 'Tampere']]
+    assert memo.stats()['hits'] == 2 and memo.stats()['misses'] == 3
+    # the lemmatizer is back in the pipeline afterwards
+    assert 'stub_lemmatizer' in tagger.ner_pipeline.pipe_names
+
+    memo.save()
+    loaded = lemma_memo(path=str(tmp_path / 'lemmas.json'))
+    assert loaded.get(('Helsingissä', 'GPE', True)) == 'Helsinki'
+
+
+def test_lemma_memo_filtered(tmp_path):
+    nlp = build_stub_pipeline()
+    nlp.get_pipe('entity_ruler').add_patterns([{'label': 'GPE', 'pattern': 'X'}])
+    nlp.to_disk(tmp_path / 'pipeline')
+    tagger = toponym_tagger(str(tmp_path / 'pipeline'), use_gpu=False, lemma_memo=True, lemmatize_on_miss=True)
+
+    res = tagger.tag_sentences(["X ja Kampissa"], None)
+    assert res['topo_lemmas'].tolist() == [['Kamppi']]
+    # the filtered one-character toponym isn't memoized, so it mustn't count as a miss either
+    assert not tagger.has_memo_misses(tagger.ner_pipeline("X ja Kampissa"))
+
+
+def test_token_budget(pipeline_path):
+    texts = ["Menen Tampereelle", "Olin Kampissa. " * 5 + "Sitten Helsingissä ja Tampereella.", "",
+             "Helsinki " + "ja niin edelleen " * 10]
+    expected = toponym_tagger(pipeline_path, use_gpu=False).tag_sentences(texts, None)
+
+    tagger = toponym_tagger(pipeline_path, use_gpu=False, token_budget=20, max_text_tokens=8)
+    assert [offset for offset, _, _ in tagger.split_text(texts[1])] == [0, 60]
+    assert tagger.token_batches([1, 2, 3, 8, 8, 10], 20) == [(0, 3), (3, 5), (5, 6)]
+
+    res = tagger.tag_sentences(texts, None)
+    for column in ('input_text', 'toponyms', 'topo_lemmas', 'topo_spans'):
+        assert res[column].tolist() == expected[column].tolist()
+    assert res['topo_spans'].tolist()[1][-1] == (82, 93)
+
+    res = tagger.tag_sentences(['@ystävä ' + text for text in texts], None, preprocess=True)
+    assert res['topo_lemmas'].tolist() == expected['topo_lemmas'].tolist()
+
+    # the windows change the spans of long texts, so they're part of the text cache key
+    stats, batches = geoparse_stats(), []
+    tagger.tag_texts(texts, stats=stats, on_batch=batches.append)
+    # the windows are tagged from the shortest, so the lemmas are passed on in another order
+    assert sorted(sum(batches, [])) == sorted(sum(expected['topo_lemmas'].dropna().tolist(), []))
+    assert stats.timers['spacy_pipe'] > 0
+
+    unbounded = toponym_tagger(pipeline_path, use_gpu=False)
+    unbounded.tag_sentences(texts[:1], None)
+    assert tagger.text_cache_key(texts[1]) != unbounded.text_cache_key(texts[1])